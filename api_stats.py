@@ -0,0 +1,166 @@
+"""Persistent latency histograms for Sheets and RTM API calls.
+
+Calls are aggregated in memory into fixed buckets and merged into
+API_STATS_FILEPATH when the process exits, so recording a call costs a few
+dictionary and list updates. Kept compatible with Python 2 for memex_daemon.
+"""
+import atexit
+import bisect
+import fcntl
+import json
+import os
+import time
+
+API_STATS_FILEPATH = "~/.walros/api_stats.json"
+FORMAT_VERSION = 1
+
+# Bucket upper bounds in milliseconds: four buckets per doubling, from 1 ms
+# to ~65 s. Slower calls land in a final overflow bucket.
+BUCKET_BOUNDS_MS = [round(2 ** (i / 4.0), 2) for i in range(65)]
+PERCENTILES = (0.5, 0.9, 0.99)
+
+_enabled = True
+_pending = {}  # (day, method) -> [bucket counts, payload bytes, statuses]
+
+
+def set_enabled(enabled):
+  global _enabled
+  _enabled = enabled
+
+
+def record(method, latency, payload_bytes, status):
+  """Records one API call. `latency` is in seconds."""
+  if not _enabled:
+    return
+  key = (time.strftime("%Y-%m-%d"), method)
+  entry = _pending.get(key)
+  if entry is None:
+    if not _pending:
+      atexit.register(flush)
+    entry = _pending[key] = [[0] * (len(BUCKET_BOUNDS_MS) + 1), 0, {}]
+  entry[0][bisect.bisect_left(BUCKET_BOUNDS_MS, latency * 1000)] += 1
+  entry[1] += payload_bytes
+  status = str(status)
+  entry[2][status] = entry[2].get(status, 0) + 1
+
+
+def flush(filepath=API_STATS_FILEPATH):
+  """Merges pending calls into the stats file."""
+  if not _pending:
+    return
+  filepath = os.path.expanduser(filepath)
+  fd = os.open(filepath, os.O_RDWR | os.O_CREAT, 0o644)
+  with os.fdopen(fd, "r+") as f:
+    fcntl.lockf(f.fileno(), fcntl.LOCK_EX)
+    contents = f.read()
+    stats = json.loads(contents) if contents else {}
+    if (stats.get("version") != FORMAT_VERSION or
+        stats.get("bounds_ms") != BUCKET_BOUNDS_MS):
+      stats = {"version": FORMAT_VERSION, "bounds_ms": BUCKET_BOUNDS_MS,
+               "days": {}}
+
+    for (day, method), (counts, payload_bytes, statuses) in _pending.items():
+      method_stats = stats["days"].setdefault(day, {}).setdefault(
+          method, {"counts": {}, "bytes": 0, "statuses": {}})
+      for i, count in enumerate(counts):
+        if count:
+          # Sparse: most buckets are empty.
+          method_stats["counts"][str(i)] = (
+              method_stats["counts"].get(str(i), 0) + count)
+      method_stats["bytes"] += payload_bytes
+      for status, count in statuses.items():
+        method_stats["statuses"][status] = (
+            method_stats["statuses"].get(status, 0) + count)
+
+    f.seek(0)
+    f.truncate()
+    f.write(json.dumps(stats, sort_keys=True))
+  _pending.clear()
+
+
+def load(filepath=API_STATS_FILEPATH):
+  filepath = os.path.expanduser(filepath)
+  if not os.path.isfile(filepath):
+    return {}
+  with open(filepath) as f:
+    stats = json.load(f)
+  if stats.get("version") != FORMAT_VERSION:
+    return {}
+  return stats["days"]
+
+
+def status_counts(filepath=API_STATS_FILEPATH):
+  """Calls per (method, status) over all days, including unflushed calls."""
+  counts = {}
+  statuses = [(method, method_stats["statuses"])
+              for methods in load(filepath).values()
+              for method, method_stats in methods.items()]
+  statuses += [(method, entry[2]) for (_, method), entry in _pending.items()]
+  for method, method_statuses in statuses:
+    for status, count in method_statuses.items():
+      counts[(method, status)] = counts.get((method, status), 0) + count
+  return counts
+
+
+def percentile(counts, q):
+  """Upper bound, in milliseconds, of the bucket holding quantile `q`."""
+  total = sum(counts)
+  threshold = q * total
+  cumulative = 0
+  for i, count in enumerate(counts):
+    cumulative += count
+    if count and cumulative >= threshold:
+      if i < len(BUCKET_BOUNDS_MS):
+        return BUCKET_BOUNDS_MS[i]
+      return float("inf")
+  return 0.0
+
+
+def report_command(days):
+  import click  # Keeps the recording path stdlib-only for memex_daemon.
+
+  stats = load()
+  cutoff = time.strftime("%Y-%m-%d", time.localtime(time.time() - days * 86400))
+  stats = dict((day, methods) for day, methods in stats.items()
+               if day > cutoff)
+  if not stats:
+    click.echo("No API calls recorded in the last %d days." % days)
+    return
+
+  def row(label, counts, payload_bytes, errors):
+    calls = sum(counts)
+    click.echo("  %-30s %7d %6d %8.0f %9.1f %9.1f %9.1f" % (
+        (label, calls, errors, payload_bytes / float(calls)) +
+        tuple(percentile(counts, q) for q in PERCENTILES)))
+
+  def header(title):
+    click.echo(title)
+    click.echo("  %-30s %7s %6s %8s %9s %9s %9s" % (
+        "", "calls", "errors", "bytes", "p50 ms", "p90 ms", "p99 ms"))
+
+  def add_method(totals, method_stats):
+    counts, payload_bytes, errors = totals
+    for i, count in method_stats["counts"].items():
+      counts[int(i)] += count
+    errors += sum(n for s, n in method_stats["statuses"].items()
+                  if s not in ("200", "ok"))
+    return counts, payload_bytes + method_stats["bytes"], errors
+
+  def new_totals():
+    return [0] * (len(BUCKET_BOUNDS_MS) + 1), 0, 0
+
+  overall = {}
+  header("Last %d days" % days)
+  for day in sorted(stats):
+    for method, method_stats in stats[day].items():
+      overall[method] = add_method(overall.get(method, new_totals()),
+                                   method_stats)
+  for method in sorted(overall):
+    row(method, *overall[method])
+
+  click.echo()
+  header("Per day")
+  for day in sorted(stats, reverse=True):
+    for method in sorted(stats[day]):
+      row("%s %s" % (day, method), *add_method(new_totals(),
+                                               stats[day][method]))
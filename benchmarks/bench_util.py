@@ -0,0 +1,32 @@
+"""Helpers shared by the benchmark scripts."""
+import json
+import os
+import sys
+import tempfile
+
+REPO_DIRPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def sandbox():
+  """Points HOME at a fresh walrOS directory and returns the new HOME.
+
+  Must run before any walrOS module is imported: config.Config reads
+  ~/.walros/config.json at import time.
+  """
+  home = tempfile.mkdtemp(prefix="walros-bench-")
+  os.environ["HOME"] = home
+  walros_dir = os.path.join(home, ".walros")
+  os.makedirs(os.path.join(walros_dir, "timer", ".signals"))
+  os.makedirs(os.path.join(walros_dir, "diary"))
+  with open(os.path.join(walros_dir, "config.json"), "w") as f:
+    json.dump({"base_dir": walros_dir, "timer_subdir": "timer",
+               "timer_signals_subdir": ".signals",
+               "diary_subdir": "diary"}, f)
+  if REPO_DIRPATH not in sys.path:
+    sys.path.insert(0, REPO_DIRPATH)
+  return home
+
+
+def percentile(sorted_values, q):
+  """The `q` quantile (0 to 1) of an ascending, non-empty list."""
+  return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""Runs memex() over synthetic tasks against the local RTM stand-in.
+
+With --iterate-only, only iterates Milk.tasks as memex() does, reporting the
+time to the first task and the peak memory growth.
+
+Exits with status 1 if two archived tasks end up with the same z-ID.
+
+Usage: python benchmarks/memex_bench.py [--tasks N] [--latency SECONDS]
+                                        [--fixture PATH] [--save PATH]
+                                        [--iterate-only]
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from datetime import datetime
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import api_stats
+import fake_rtm
+import memex_daemon
+
+
+def populate(fake, num_tasks):
+    completed = datetime.utcnow().replace(microsecond=0)
+    for i in range(num_tasks):
+        tags = ['memex', 's%d' % (2 ** (i % 6)), 'topic%d' % (i % 50)]
+        if i % 2:
+            tags.append('z%06d' % i)  # Half of the tasks already carry an ID.
+        notes = [('note', 'text %d' % i)] if i % 10 == 0 else []
+        fake.add_task('Review item %d' % i, list_id=str(i % 5 + 1), tags=tags,
+                      completed=completed - timedelta(i % 30),
+                      priority=str(i % 3 + 1), notes=notes)
+
+
+def duplicate_zids(fake):
+    '''z-IDs carried by more than one memex-archive task in the store.'''
+    seen = set()
+    duplicates = set()
+    for taskseries_list in fake.lists.values():
+        for taskseries in taskseries_list:
+            if 'memex-archive' not in taskseries['tags']:
+                continue
+            task_id = memex_daemon.id_from_tags(taskseries['tags'],
+                                                memex_daemon.ZIdIndex.PREFIX)
+            if task_id in seen:
+                duplicates.add(task_id)
+            seen.add(task_id)
+    return sorted(duplicates)
+
+
+def bench_iterate(milk):
+    # ru_maxrss is the peak so far: kilobytes on Linux, bytes on macOS.
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    first = None
+    num_tasks = 0
+    task_bytes = 0
+    for task in milk.tasks('tag:memex and status:completed'):
+        if first is None:
+            first = time.time() - start
+            task_bytes = sys.getsizeof(task)
+            if hasattr(task, '__dict__'):
+                task_bytes += sys.getsizeof(task.__dict__)
+        task.completed  # memex() reads every task's completion date.
+        num_tasks += 1
+    elapsed = time.time() - start
+    rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+
+    print('tasks:             %d' % num_tasks)
+    print('first task (ms):   %.1f' % ((first or 0) * 1000))
+    print('elapsed (s):       %.3f' % elapsed)
+    print('task record bytes: %d (without fields)' % task_bytes)
+    print('peak rss growth:   %d' % rss_growth)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--fixture', help='Load tasks from a recorded fixture.')
+    parser.add_argument('--save', help='Save the resulting store as a fixture.')
+    parser.add_argument('--iterate-only', action='store_true',
+                        help='Only iterate the tasks memex() would process.')
+    args = parser.parse_args()
+    api_stats.set_enabled(False)  # Keep synthetic calls out of real stats.
+
+    fake = fake_rtm.Rtm(latency=args.latency, fixture_filepath=args.fixture)
+    if not args.fixture:
+        populate(fake, args.tasks)
+    milk = memex_daemon.Milk(None, None, None, 'delete',
+                             rtm_class=lambda *a: fake)
+    num_tasks = sum(len(l) for l in fake.lists.values())
+    if args.iterate_only:
+        bench_iterate(milk)
+        return
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')  # memex() prints every task name.
+    dirpath = tempfile.mkdtemp()
+    journal = memex_daemon.Journal(os.path.join(dirpath, 'journal.json'))
+    zids = memex_daemon.ZIdIndex(os.path.join(dirpath, 'zids'))
+    start = time.time()
+    try:
+        memex_daemon.memex(milk, journal, zids)
+    finally:
+        elapsed = time.time() - start
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    total_calls = sum(fake.calls.values())
+    print('tasks:        %d' % num_tasks)
+    print('elapsed (s):  %.3f' % elapsed)
+    print('tasks/s:      %.1f' % (num_tasks / elapsed))
+    print('api calls:    %d (%.2f per task)' %
+          (total_calls, float(total_calls) / max(num_tasks, 1)))
+    for method, count in sorted(fake.calls.items()):
+        print('  %-18s %d' % (method, count))
+    print('z-ids in use: %d' % len(zids))
+
+    if args.save:
+        fake.save_fixture(args.save)
+
+    duplicates = duplicate_zids(fake)
+    if duplicates:
+        print('DUPLICATE z-IDs among archived tasks: %s' %
+              ', '.join(duplicates))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Compares Spreadsheet and AsyncSpreadsheet against a local Sheets stand-in.
+
+The stand-in answers the Sheets v4 endpoints used by data_util after a fixed
+delay, and the real API client is pointed at it through the discovery
+document bundled with google-api-python-client.
+
+Usage: python3 benchmarks/sheets_bench.py [--calls N] [--latency SECONDS]
+"""
+import argparse
+import asyncio
+import http.server
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from googleapiclient import discovery
+from googleapiclient import discovery_cache
+import httplib2
+
+import api_stats
+import data_util
+import rate_limit
+
+SPREADSHEET_ID = "bench"
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+  latency = 0.0
+
+  def do_GET(self):
+    if "/values/" in self.path:
+      self._reply({"values": [["42"]]})
+    else:
+      self._reply({"sheets": [{"data": [{"rowData": [
+          {"values": [{"formattedValue": "2016-01-01 Friday"}]}]}]}]})
+
+  def do_POST(self):
+    self.rfile.read(int(self.headers.get("Content-Length", 0)))
+    self._reply({"spreadsheetId": SPREADSHEET_ID, "replies": []})
+
+  def _reply(self, obj):
+    time.sleep(self.latency)
+    body = json.dumps(obj).encode()
+    self.send_response(200)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+def start_stand_in(latency):
+  StandInHandler.latency = latency
+  server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server
+
+
+def build_sheets(port):
+  doc = json.loads(discovery_cache.get_static_doc("sheets", "v4"))
+  doc["rootUrl"] = "http://127.0.0.1:%d/" % port
+  service = discovery.build_from_document(doc, http=httplib2.Http())
+  return service.spreadsheets()
+
+
+def calls(spreadsheet, num_calls):
+  """Independent reads and writes, as issued by init and timer completion."""
+  for i in range(num_calls):
+    if i % 3 == 0:
+      yield spreadsheet.GetRanges, (["Time!A%d" % (i + 1)], "sheets(data)")
+    elif i % 3 == 1:
+      yield spreadsheet.GetCellValue, ("Time", i + 1, 2)
+    else:
+      yield spreadsheet.BatchUpdate, ([],)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--calls", type=int, default=60)
+  parser.add_argument("--latency", type=float, default=0.05)
+  parser.add_argument("--pool-size", type=int, default=data_util.ASYNC_POOL_SIZE)
+  args = parser.parse_args()
+  api_stats.set_enabled(False)  # Keep synthetic calls out of real stats.
+
+  server = start_stand_in(args.latency)
+  sheets = build_sheets(server.server_address[1])
+  # Measure the clients, not the quota.
+  limiter = rate_limit.TokenBucket(
+      os.path.join(tempfile.mkdtemp(), "rate_limit.json"), rate=1e9, burst=1e9)
+
+  spreadsheet = data_util.Spreadsheet(SPREADSHEET_ID, sheets, limiter)
+  start = time.time()
+  for fn, fn_args in calls(spreadsheet, args.calls):
+    fn(*fn_args)
+  sync_elapsed = time.time() - start
+
+  async_spreadsheet = data_util.AsyncSpreadsheet(
+      SPREADSHEET_ID, args.pool_size, sheets, limiter, httplib2.Http)
+
+  async def run_async():
+    await asyncio.gather(*[fn(*fn_args) for fn, fn_args in
+                           calls(async_spreadsheet, args.calls)])
+  start = time.time()
+  asyncio.run(run_async())
+  async_elapsed = time.time() - start
+
+  server.shutdown()
+  print("calls:            %d (%.0f ms simulated latency each)" %
+        (args.calls, args.latency * 1000))
+  print("sync (s):         %.3f" % sync_elapsed)
+  print("async x%d (s):     %.3f" % (args.pool_size, async_elapsed))
+  print("speedup:          %.1fx" % (sync_elapsed / async_elapsed))
+
+
+if __name__ == "__main__":
+  main()
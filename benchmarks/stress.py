@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""Stress test of the local timer and diary stores at increasing sizes.
+
+For each store size, the temporary walrOS directory (see bench_util.sandbox)
+is filled with that many paused timers and diary entries, and then several
+processes run a random mix of timer and diary commands against it at the
+same time for a fixed duration. Reported per size:
+
+  - throughput and latency percentiles of each command;
+  - lock contention: how long OpenAndLock took to acquire the timer_db and
+    diary locks, and the share of the workers' time spent waiting for them.
+
+Commands are the ones behind the CLI (timer.status_command etc.) with their
+output discarded. By default the per-process JSON cache is dropped before
+each command, as every CLI invocation starts with an empty one; --warm keeps
+it, as a long-lived process would.
+
+Usage: python3 benchmarks/stress.py [--sizes N,N,...] [--processes P]
+                                    [--duration S] [--mix OP=W,...] [--warm]
+                                    [--keep]
+"""
+import argparse
+import collections
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import time
+
+import bench_util
+
+FOREGROUND_LABEL = "stress-foreground"  # The running timer `inc` changes.
+TIMER_DURATION_HOURS = 10  # Outlasts any run.
+COMMANDS = ("start", "inc", "clear", "status", "diary")
+DEFAULT_MIX = "start=1,inc=2,clear=1,status=2,diary=2"
+
+
+def timer_label(i):
+  return "t%06d" % i
+
+
+def diary_label(i):
+  return "d%06d" % i
+
+
+def populate(size):
+  """Tops the stores up to `size` timers and diary entries.
+
+  Returns the number of files written.
+  """
+  import diary
+  import timer_db
+  import util
+
+  written = 0
+  now = time.time()
+  for i in range(size):
+    filepath = timer_db._timer_filepath(timer_label(i))
+    if not os.path.exists(filepath):
+      util.write_json_atomic(filepath, {
+        "label": timer_label(i),
+        "endtime": 0,
+        "remaining": 1800,
+        "interruptions": 0,
+      })
+      written += 1
+    filepath = diary._resource_path(diary_label(i))
+    if not os.path.exists(filepath):
+      util.write_json_atomic(filepath, {
+        "label": diary_label(i),
+        "epoch": now,
+        "interval_start_time": now,
+        "effective": 0.0,
+      })
+      written += 1
+
+  with timer_db.Transaction() as txn:
+    timer = txn.timer(FOREGROUND_LABEL)
+    if not timer.is_running:
+      timer.start(0, 0, TIMER_DURATION_HOURS)
+  if not os.path.exists(diary._resource_path(FOREGROUND_LABEL)):
+    diary.new_command(FOREGROUND_LABEL)
+  util._json_cache.clear()  # Workers start like fresh processes.
+  return written
+
+
+def make_ops(size):
+  """COMMANDS name -> function running it against a random label."""
+  import diary
+  import timer
+
+  def start():
+    timer.schedule_command(timer_label(random.randrange(size)), 0, 30, 0,
+                           1, False, False)
+
+  def clear():
+    timer.clear_command(timer_label(random.randrange(size)))
+
+  return {
+    # Scheduled, since only one foreground timer may run at a time.
+    "start": start,
+    "inc": lambda: timer.inc_command(1),
+    "clear": clear,
+    "status": lambda: timer.status_command(False),
+    "diary": lambda: diary.increment_effective(
+        diary_label(random.randrange(size)), 1.0),
+  }
+
+
+def worker(size, mix, duration, warm, barrier, results):
+  import profiler
+  import util
+
+  sys.stdout = open(os.devnull, "w")  # Command output.
+  random.seed(os.getpid())
+  ops = make_ops(size)
+  names, weights = zip(*mix)
+  latencies = collections.defaultdict(list)
+  profiler.enable()  # Records OpenAndLock spans.
+
+  barrier.wait()
+  start = time.perf_counter()
+  end = start + duration
+  while time.perf_counter() < end:
+    name = random.choices(names, weights)[0]
+    if not warm:
+      util._json_cache.clear()
+    op_start = time.perf_counter()
+    ops[name]()
+    latencies[name].append(time.perf_counter() - op_start)
+  elapsed = time.perf_counter() - start
+
+  lock_waits = collections.defaultdict(list)
+  for seconds, args in profiler.spans("OpenAndLock"):
+    store = os.path.basename(os.path.dirname(args["path"]))
+    lock_waits[store].append(seconds)
+  results.put((dict(latencies), dict(lock_waits), elapsed))
+
+
+def run(size, mix, processes, duration, warm):
+  ctx = multiprocessing.get_context()
+  barrier = ctx.Barrier(processes)
+  results = ctx.Queue()
+  workers = [ctx.Process(target=worker,
+                         args=(size, mix, duration, warm, barrier, results))
+             for _ in range(processes)]
+  for p in workers:
+    p.start()
+  # Drain the queue before joining; large results block the workers' exit.
+  outputs = [results.get() for _ in workers]
+  for p in workers:
+    p.join()
+
+  latencies = collections.defaultdict(list)
+  lock_waits = collections.defaultdict(list)
+  worker_seconds = 0.0
+  for op_latencies, op_lock_waits, elapsed in outputs:
+    for name, values in op_latencies.items():
+      latencies[name] += values
+    for store, values in op_lock_waits.items():
+      lock_waits[store] += values
+    worker_seconds += elapsed
+  return latencies, lock_waits, worker_seconds / processes
+
+
+def report(latencies, lock_waits, elapsed, processes):
+  print("  %-8s %8s %9s %10s %10s %10s" % (
+      "command", "count", "ops/s", "p50 ms", "p99 ms", "max ms"))
+  for name in sorted(latencies):
+    values = sorted(latencies[name])
+    print("  %-8s %8d %9.1f %10.2f %10.2f %10.2f" % (
+        name, len(values), len(values) / elapsed,
+        bench_util.percentile(values, 0.5) * 1000,
+        bench_util.percentile(values, 0.99) * 1000, values[-1] * 1000))
+  total = sum(len(v) for v in latencies.values())
+  print("  %-8s %8d %9.1f" % ("all", total, total / elapsed))
+
+  print("  %-8s %8s %9s %10s %10s %10s" % (
+      "lock", "acquired", "waiting", "p50 ms", "p99 ms", "max ms"))
+  for store in sorted(lock_waits):
+    values = sorted(lock_waits[store])
+    print("  %-8s %8d %8.1f%% %10.2f %10.2f %10.2f" % (
+        store, len(values), 100 * sum(values) / (elapsed * processes),
+        bench_util.percentile(values, 0.5) * 1000,
+        bench_util.percentile(values, 0.99) * 1000, values[-1] * 1000))
+
+
+def parse_mix(mix):
+  pairs = []
+  for item in mix.split(","):
+    name, weight = item.split("=")
+    pairs.append((name, float(weight)))
+  return pairs
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--sizes", default="1000,10000,100000",
+                      help="Comma-separated store sizes, run in order.")
+  parser.add_argument("--processes", type=int, default=4)
+  parser.add_argument("--duration", type=float, default=10.0,
+                      help="Seconds of load per store size.")
+  parser.add_argument("--mix", default=DEFAULT_MIX,
+                      help="Relative weights of the commands: %s." %
+                           ", ".join(COMMANDS))
+  parser.add_argument("--warm", action="store_true",
+                      help="Keep each process's JSON cache across commands.")
+  parser.add_argument("--keep", action="store_true",
+                      help="Leave the generated store in place afterwards.")
+  args = parser.parse_args()
+  mix = parse_mix(args.mix)
+  unknown = set(name for name, _ in mix) - set(COMMANDS)
+  if unknown:
+    parser.error("unknown commands in --mix: %s" % ", ".join(sorted(unknown)))
+
+  home = bench_util.sandbox()
+  print("store: %s, %d processes, %.0f s per size, %s cache" % (
+      home, args.processes, args.duration, "warm" if args.warm else "cold"))
+  for size in (int(s) for s in args.sizes.split(",")):
+    start = time.time()
+    written = populate(size)
+    print("\n%d timers and diary entries (%d files written in %.1f s)" % (
+        size, written, time.time() - start))
+    latencies, lock_waits, elapsed = run(size, mix, args.processes,
+                                         args.duration, args.warm)
+    report(latencies, lock_waits, elapsed, args.processes)
+
+  if not args.keep:
+    shutil.rmtree(home)
+
+
+if __name__ == "__main__":
+  main()
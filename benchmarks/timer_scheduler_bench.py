@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Measures how promptly one Scheduler fires hundreds of simultaneous timers.
+
+Timers are real timer_db files in a temporary walrOS directory (see
+bench_util.sandbox). Completions only record their firing time and clear the
+timer, so no Sheets calls are made.
+
+Usage: python3 benchmarks/timer_scheduler_bench.py [--timers N] [--spread S]
+"""
+import argparse
+import threading
+import time
+
+import bench_util
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--timers", type=int, default=500)
+  parser.add_argument("--spread", type=float, default=5.0,
+                      help="Seconds over which end times are spread.")
+  args = parser.parse_args()
+  bench_util.sandbox()
+
+  import timer_db
+  import timer_scheduler
+
+  lateness = []
+  lock = threading.Lock()
+
+  def on_complete(label, count, track):
+    late = time.time() - endtimes[label]
+    with timer_db.TimerFileProxy(label) as timer:
+      timer.clear()
+    with lock:
+      lateness.append(late)
+
+  start = time.time() + 1.0
+  endtimes = {}
+  with timer_db.Transaction() as txn:
+    for i in range(args.timers):
+      label = "t%04d" % i
+      timer = txn.timer(label)
+      timer.schedule(1, True)
+      timer.start(1.0 + args.spread * i / args.timers, 0, 0)
+      endtimes[label] = timer.endtime
+
+  scheduler = timer_scheduler.Scheduler(on_complete)
+  cpu_start = time.process_time()
+  wall_start = time.time()
+  scheduler.reload()
+  reload_elapsed = time.time() - wall_start
+  wakeups = 0
+  while len(scheduler):
+    scheduler.fire_due()
+    deadline = scheduler.next_deadline()
+    if deadline is not None:
+      time.sleep(max(deadline - time.time(), 0))
+      wakeups += 1
+  scheduler.wait_idle()
+  cpu = time.process_time() - cpu_start
+  wall = time.time() - start
+
+  lateness.sort()
+  def pct(q):
+    return bench_util.percentile(lateness, q) * 1000
+
+  print("timers:           %d over %.1f s" % (args.timers, args.spread))
+  print("fired:            %d" % len(lateness))
+  print("initial load (ms): %.1f" % (reload_elapsed * 1000))
+  print("wakeups:          %d" % wakeups)
+  print("lateness ms:      p50 %.1f  p99 %.1f  max %.1f" % (
+      pct(0.5), pct(0.99), lateness[-1] * 1000))
+  print("cpu (s):          %.3f of %.3f wall" % (cpu, wall))
+
+
+if __name__ == "__main__":
+  main()
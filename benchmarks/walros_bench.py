@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""Microbenchmarks for walrOS's local hot paths, compared against baselines.
+
+Benchmarks run against a temporary walrOS directory (see bench_util.sandbox)
+and report the median time per operation over several repeats. Results are
+compared with BASELINES_FILEPATH; anything slower than the baseline by more
+than --threshold is flagged, as is any benchmark over its fixed budget.
+Baselines are machine-specific: record them with --save on the machine you
+compare on.
+
+Usage: python3 benchmarks/walros_bench.py [--save] [--filter SUBSTRING]
+                                          [--threshold RATIO]
+"""
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import bench_util
+
+BASELINES_FILEPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  "baselines.json")
+NUM_TIMERS = 50  # Stored timers in the timer_db benchmarks.
+MIN_REPEAT_TIME = 0.05  # Seconds per repeat.
+REPEATS = 7
+COLD_START_REPEATS = 5
+COMPLETION_BUDGET = 0.2  # Seconds. Completion runs on every keystroke.
+
+_benchmarks = []  # (name, fn returning seconds per operation, budget)
+
+
+def benchmark(name, budget=None):
+  """Registers a benchmark. Results over `budget` seconds are reported as
+  regressions whatever the baseline."""
+  def decorator(fn):
+    _benchmarks.append((name, fn, budget))
+    return fn
+  return decorator
+
+
+def time_per_op(op, setup=None):
+  """Median seconds per call of `op` over REPEATS timed repeats."""
+  if setup:
+    setup()
+  number = 1
+  while True:  # Calibrate calls per repeat.
+    start = time.perf_counter()
+    for _ in range(number):
+      op()
+    elapsed = time.perf_counter() - start
+    if elapsed >= MIN_REPEAT_TIME:
+      break
+    number *= 2
+  samples = []
+  for _ in range(REPEATS):
+    start = time.perf_counter()
+    for _ in range(number):
+      op()
+    samples.append((time.perf_counter() - start) / number)
+  return statistics.median(samples)
+
+
+# -- timer_db --
+
+def populate_timers():
+  import timer_db
+  with timer_db.Transaction() as txn:
+    for timer in txn.existing_timers():
+      timer.clear()
+    for i in range(NUM_TIMERS):
+      timer = txn.timer("label%03d" % i)
+      timer.start(0, 30, 0)
+      timer.pause()
+    txn.timer("running").start(0, 30, 0)
+
+
+@benchmark("timer_db.TimerFileProxy enter/exit")
+def bench_timer_proxy():
+  import timer_db
+  def op():
+    with timer_db.TimerFileProxy("running") as timer:
+      timer.remaining
+  return time_per_op(op, populate_timers)
+
+
+@benchmark("timer_db.TimerFileProxy inc")
+def bench_timer_inc():
+  import timer_db
+  def op():
+    with timer_db.TimerFileProxy("running") as timer:
+      timer.inc(1)
+  return time_per_op(op, populate_timers)
+
+
+@benchmark("timer_db.running_timer")
+def bench_running_timer():
+  import timer_db
+  return time_per_op(timer_db.running_timer, populate_timers)
+
+
+@benchmark("timer_db.existing_timers")
+def bench_existing_timers():
+  import timer_db
+  def op():
+    with timer_db.Transaction() as txn:
+      txn.existing_timers()
+  return time_per_op(op, populate_timers)
+
+
+# -- diary --
+
+@benchmark("diary.Entry enter/exit")
+def bench_diary_entry():
+  import diary
+  def setup():
+    diary.setup()
+    diary.new_command("entry")
+  def op():
+    with diary.Entry("entry"):
+      pass
+  return time_per_op(op, setup)
+
+
+@benchmark("diary.increment_effective")
+def bench_increment_effective():
+  import diary
+  def setup():
+    diary.setup()
+    diary.new_command("effective")
+  return time_per_op(lambda: diary.increment_effective("effective", 1.0),
+                     setup)
+
+
+# -- walros_base --
+
+def new_day_benchmark(gap_days):
+  def bench():
+    import data_util
+    import timer
+    import walros_base
+    tracker_data = timer.init_tracker_data()
+    # Request builders only; skip the API client Worksheet() would build.
+    worksheet = data_util.Worksheet.__new__(data_util.Worksheet)
+    worksheet.spreadsheet_id_ = walros_base.SPREADSHEET_ID
+    worksheet.worksheet_id_ = tracker_data.worksheet_id
+    today = datetime.date(2017, 3, 15)
+    row = tracker_data.last_day_row_index
+
+    def op():
+      merges = [walros_base.build_new_merge_ranges(worksheet, row, indices)
+                for indices in (tracker_data.week_merge_column_indices,
+                                tracker_data.month_merge_column_indices,
+                                tracker_data.quarter_merge_column_indices)]
+      walros_base.build_new_day_requests(
+          tracker_data, worksheet, today,
+          today - datetime.timedelta(gap_days), *merges)
+    return time_per_op(op)
+  return bench
+
+
+for _gap_days in (1, 7, 30, 365):
+  benchmark("walros_base.build_new_day_requests %d days" % _gap_days)(
+      new_day_benchmark(_gap_days))
+
+
+@benchmark("walros_base.col_num_to_letter x1000")
+def bench_col_num_to_letter():
+  import walros_base
+  def op():
+    for i in range(1, 1001):
+      walros_base.col_num_to_letter(i)
+  return time_per_op(op)
+
+
+@benchmark("data_util.num2col x1000")
+def bench_num2col():
+  import data_util
+  def op():
+    for i in range(1, 1001):
+      data_util.num2col(i)
+  return time_per_op(op)
+
+
+# -- CLI cold start --
+
+def cold_start_benchmark(*args, env=None, script="walros.py"):
+  def bench():
+    populate_timers()
+    command = [sys.executable, os.path.join(bench_util.REPO_DIRPATH,
+                                            script)] + list(args)
+    samples = []
+    for _ in range(COLD_START_REPEATS):
+      start = time.perf_counter()
+      subprocess.check_call(command, stdout=subprocess.DEVNULL,
+                            env=dict(os.environ, **(env or {})))
+      samples.append(time.perf_counter() - start)
+    return min(samples)  # Least disturbed by the rest of the machine.
+  return bench
+
+
+benchmark("cold start: walros --help")(cold_start_benchmark("--help"))
+benchmark("cold start: walros timer status")(
+    cold_start_benchmark("timer", "status"))
+benchmark("cold start: status_segment.py")(
+    cold_start_benchmark(script="status_segment.py"))
+benchmark("completion: walros timer start", budget=COMPLETION_BUDGET)(
+    cold_start_benchmark(env={"_WALROS_COMPLETE": "complete",
+                              "COMP_WORDS": "walros.py timer start la",
+                              "COMP_CWORD": "3"}))
+
+
+def report(results, budgets, baselines, threshold):
+  regressions = 0
+  print("%-48s %12s %12s %8s" % ("benchmark", "time", "baseline", "ratio"))
+  for name, seconds in results.items():
+    baseline = baselines.get(name)
+    if baseline:
+      ratio = seconds / baseline
+      flag = ""
+      if ratio > threshold:
+        flag = "  SLOWER"
+        regressions += 1
+      elif ratio < 1 / threshold:
+        flag = "  faster"
+      line = "%-48s %12s %12s %7.2fx%s" % (
+          name, format_seconds(seconds), format_seconds(baseline), ratio,
+          flag)
+    else:
+      line = "%-48s %12s %12s" % (name, format_seconds(seconds), "-")
+    budget = budgets.get(name)
+    if budget is not None and seconds > budget:
+      line += "  OVER BUDGET (%s)" % format_seconds(budget)
+      regressions += 1
+    print(line)
+  return regressions
+
+
+def format_seconds(seconds):
+  for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+    if seconds >= scale:
+      return "%.2f %s" % (seconds / scale, unit)
+  return "%.0f ns" % (seconds / 1e-9)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--save", action="store_true",
+                      help="Store the results as the new baselines.")
+  parser.add_argument("--filter", default="",
+                      help="Only run benchmarks whose name contains this.")
+  parser.add_argument("--threshold", type=float, default=1.25,
+                      help="Slowdown ratio reported as a regression.")
+  args = parser.parse_args()
+
+  bench_util.sandbox()
+  results = {}
+  budgets = {}
+  for name, bench, budget in _benchmarks:
+    if args.filter in name:
+      results[name] = bench()
+      budgets[name] = budget
+
+  baselines = {}
+  if os.path.isfile(BASELINES_FILEPATH):
+    with open(BASELINES_FILEPATH) as f:
+      baselines = json.load(f)
+  regressions = report(results, budgets, baselines, args.threshold)
+
+  if args.save:
+    baselines.update(results)
+    with open(BASELINES_FILEPATH, "w") as f:
+      json.dump(baselines, f, indent=2, sort_keys=True)
+      f.write("\n")
+    print("Baselines saved to %s" % BASELINES_FILEPATH)
+  elif regressions:
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -27,3 +27,12 @@ class Config(object):
   def diary_dir(self):
     return os.path.join(self.base_dir,
                         self._config_obj['diary_subdir'])
+
+  @property
+  def materialized(self):
+    return self._config_obj.get('materialized', False)
+
+  @property
+  def prometheus_textfile(self):
+    filepath = self._config_obj.get('prometheus_textfile')
+    return os.path.expanduser(filepath) if filepath else None
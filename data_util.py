@@ -1,47 +1,156 @@
+import asyncio
+import collections
+import concurrent.futures
+import datetime
+import email.utils
 import os
 import functools
 from enum import Enum
+import random
 import string
+import threading
+import time
 
 from apiclient import discovery
+from apiclient import errors
 import httplib2
 import oauth2client
 import oauth2client.file
 from oauth2client import client
 from oauth2client import tools
+from oauth2client.service_account import ServiceAccountCredentials
+
+import api_stats
+import profiler
+import rate_limit
+import util
 
 # TODO: move to walros_base
 APPLICATION_NAME = "walrOS"
 PERMISSION_SCOPES = "https://www.googleapis.com/auth/spreadsheets"
 CLIENT_SECRET_FILEPATH = "~/.walros/client_secret.json"
 
+# Headless deployments authenticate with a service account key instead of the
+# interactive OAuth2 flow. The key is used whenever this file exists.
+SERVICE_ACCOUNT_FILEPATH = "~/.walros/service_account.json"
+HEADLESS_ENV = "WALROS_HEADLESS"  # If set, never run the interactive flow.
+
+# Cached access tokens are refreshed this long before they expire.
+TOKEN_REFRESH_MARGIN = 300  # Seconds.
+TOKEN_REFRESH_RETRY_DELAY = 60  # Seconds; doubles after each failure.
+TOKEN_REFRESH_MAX_DELAY = 3600  # Seconds.
+
+# Retries with jittered exponential backoff, unless the response carries a
+# Retry-After header.
+RETRYABLE_STATUSES = (429, 500, 503)
+# Methods that must not run twice. A 5xx may come after the request was
+# applied, so these are only retried when rejected for quota (429).
+NON_IDEMPOTENT_METHODS = ("BatchUpdate",)
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0  # Seconds.
+BACKOFF_MAX = 32.0  # Seconds.
+REPORT_WAIT_THRESHOLD = 1.0  # Calls that wait longer than this are logged.
+
+CALL_STATS_MAX = 1000  # Calls kept in `call_stats`.
+
+# Concurrent connections used by AsyncSpreadsheet.
+ASYNC_POOL_SIZE = 4
+
 TEST_SPREADSHEET_ID = '1P_e-Tu-ZeY4fHluoMEmtg9p5pq7OLddoEEdhNqEvyVQ'
 TEST_WORKSHEET_ID = 0
 
 class Spreadsheet(object):
 
-  def __init__(self, spreadsheet_id):
+  def __init__(self, spreadsheet_id, sheets=None, rate_limiter=None):
     self.spreadsheet_id_ = spreadsheet_id
-    self.sheets_ = GetSpreadsheets()
+    self.sheets_ = sheets or GetSpreadsheets()
+    self.rate_limiter_ = rate_limiter
 
   def GetWorksheet(self, worksheet_id):
     return Worksheet(self.spreadsheet_id_, worksheet_id)
 
   def GetRanges(self, ranges, fields):
+    return Execute("GetRanges", self.NewGetRangesRequest(ranges, fields),
+                   self.rate_limiter_)
+
+  def GetCellValue(self, worksheet_name, row, col):
+    response = Execute("GetCellValue",
+                       self.NewGetCellValueRequest(worksheet_name, row, col),
+                       self.rate_limiter_)
+    return response["values"][0][0]
+
+  def GetValues(self, ranges):
+    """Returns the rows of each range, with numbers left unformatted."""
+    response = Execute("GetValues", self.NewGetValuesRequest(ranges),
+                       self.rate_limiter_)
+    return [r.get("values", []) for r in response["valueRanges"]]
+
+  def BatchUpdate(self, batch_requests):
+    return Execute("BatchUpdate", self.NewBatchUpdateRequest(batch_requests),
+                   self.rate_limiter_)
+
+  def NewGetRangesRequest(self, ranges, fields):
     return self.sheets_.get(spreadsheetId=self.spreadsheet_id_,
                             includeGridData=False, ranges=ranges,
-                            fields=fields).execute()
+                            fields=fields)
 
-  def GetCellValue(self, worksheet_name, row, col):
-    request = self.sheets_.values().get(
+  def NewGetCellValueRequest(self, worksheet_name, row, col):
+    return self.sheets_.values().get(
         spreadsheetId=self.spreadsheet_id_,
         range="%s!%s%d" % (worksheet_name, num2col(col), row))
-    response = request.execute()
-    return response["values"][0][0]
 
-  def BatchUpdate(self, batch_requests):
+  def NewGetValuesRequest(self, ranges):
+    return self.sheets_.values().batchGet(
+        spreadsheetId=self.spreadsheet_id_, ranges=ranges,
+        valueRenderOption="UNFORMATTED_VALUE",
+        dateTimeRenderOption="FORMATTED_STRING")
+
+  def NewBatchUpdateRequest(self, batch_requests):
     return self.sheets_.batchUpdate(spreadsheetId=self.spreadsheet_id_,
-                                    body={'requests': batch_requests}).execute()
+                                    body={'requests': batch_requests})
+
+
+class AsyncSpreadsheet(object):
+  """Asynchronous counterpart of Spreadsheet.
+
+  Requests are built on the event loop thread and executed on a pool of
+  threads, each holding its own authorized connection, so independent calls
+  run concurrently.
+  """
+
+  def __init__(self, spreadsheet_id, pool_size=ASYNC_POOL_SIZE, sheets=None,
+               rate_limiter=None, http_factory=None):
+    self.spreadsheet_ = Spreadsheet(spreadsheet_id, sheets, rate_limiter)
+    self.executor_ = concurrent.futures.ThreadPoolExecutor(pool_size)
+    self.http_factory_ = http_factory or NewAuthorizedHttp
+    self.local_ = threading.local()
+
+  def GetWorksheet(self, worksheet_id):
+    return self.spreadsheet_.GetWorksheet(worksheet_id)
+
+  async def GetRanges(self, ranges, fields):
+    return await self._Execute(
+        "GetRanges", self.spreadsheet_.NewGetRangesRequest(ranges, fields))
+
+  async def GetCellValue(self, worksheet_name, row, col):
+    response = await self._Execute(
+        "GetCellValue",
+        self.spreadsheet_.NewGetCellValueRequest(worksheet_name, row, col))
+    return response["values"][0][0]
+
+  async def BatchUpdate(self, batch_requests):
+    return await self._Execute(
+        "BatchUpdate", self.spreadsheet_.NewBatchUpdateRequest(batch_requests))
+
+  def _Execute(self, method, request):
+    def execute():
+      # httplib2.Http is not thread-safe; give each pool thread its own.
+      if not hasattr(self.local_, "http"):
+        self.local_.http = self.http_factory_()
+      return Execute(method, request, self.spreadsheet_.rate_limiter_,
+                     self.local_.http)
+    return asyncio.get_event_loop().run_in_executor(self.executor_, execute)
+
 
 class Worksheet(object):
 
@@ -131,21 +240,32 @@ def memoize(init_fn):
   return wrapper_fn
 
 
+def NewAuthorizedHttp():
+  return GetCredentials().authorize(httplib2.Http())
+
+
 @memoize
 def GetSpreadsheets():
-  credentials = GetCredentials()
-  http = credentials.authorize(httplib2.Http())
+  http = NewAuthorizedHttp()
   discoveryUrl = ('https://sheets.googleapis.com/$discovery/rest?version=v4')
-  service = discovery.build('sheets', 'v4', http=http,
-                            discoveryServiceUrl=discoveryUrl,
-                            num_retries=3)
+  with profiler.span("discovery.build"):
+    service = discovery.build('sheets', 'v4', http=http,
+                              discoveryServiceUrl=discoveryUrl,
+                              num_retries=3)
   return service.spreadsheets()
 
+@memoize
+@profiler.traced("GetCredentials")
 def GetCredentials():
-    """Gets valid user credentials from storage.
+    """Gets valid credentials from storage.
+
+    If a service account key exists, it is used and its access tokens are
+    cached alongside the user credentials. Otherwise, if nothing has been
+    stored, or if the stored credentials are invalid, the OAuth2 flow is run
+    to obtain new credentials, unless running headless.
 
-    If nothing has been stored, or if the stored credentials are invalid,
-    the OAuth2 flow is run to obtain the new credentials.
+    In both cases, a background thread keeps the cached access token fresh
+    for as long as the process runs.
 
     Returns:
         The obtained credentials.
@@ -153,12 +273,32 @@ def GetCredentials():
     credential_dir = os.path.join(os.path.expanduser('~'), '.credentials')
     if not os.path.exists(credential_dir):
         os.makedirs(credential_dir)
+
+    service_account_path = os.path.expanduser(SERVICE_ACCOUNT_FILEPATH)
+    if os.path.isfile(service_account_path):
+        store = oauth2client.file.Storage(os.path.join(
+            credential_dir, 'sheets.googleapis.com-walros-service.json'))
+        credentials = store.get()
+        if not credentials or credentials.invalid:
+            credentials = ServiceAccountCredentials.from_json_keyfile_name(
+                service_account_path, scopes=PERMISSION_SCOPES)
+            credentials.set_store(store)
+        StartTokenRefresher(credentials)
+        return credentials
+
     credential_path = os.path.join(credential_dir,
                                    'sheets.googleapis.com-walros.json')
 
     store = oauth2client.file.Storage(credential_path)
     credentials = store.get()
     if not credentials or credentials.invalid:
+        if os.environ.get(HEADLESS_ENV):
+            raise Exception("No valid credentials in %s and %s is set; run "
+                            "walrOS interactively once or install a service "
+                            "account key at %s." %
+                            (credential_path, HEADLESS_ENV,
+                             SERVICE_ACCOUNT_FILEPATH))
+
         flow = client.flow_from_clientsecrets(os.path.expanduser(
                                                   CLIENT_SECRET_FILEPATH),
                                               PERMISSION_SCOPES)
@@ -172,8 +312,156 @@ def GetCredentials():
         setattr(flags_namespace, 'auth_host_port', [8080, 8090])
         credentials = tools.run_flow(flow, store, flags_namespace)
         print('Storing credentials to ' + credential_path)
+    StartTokenRefresher(credentials)
     return credentials
 
+
+def SecondsUntilRefresh(credentials, margin=TOKEN_REFRESH_MARGIN):
+  """Returns how long the cached access token can be used before refreshing.
+  """
+  if not credentials.access_token or not credentials.token_expiry:
+    return 0
+  remaining = credentials.token_expiry - datetime.datetime.utcnow()
+  return max(remaining.total_seconds() - margin, 0)
+
+
+def RefreshCredentials(margin=TOKEN_REFRESH_MARGIN):
+  """Refreshes the cached access token if it expires within `margin` seconds.
+
+  Refreshed tokens are written back to the credential store, so running this
+  periodically (e.g. from cron) spares every other process the refresh.
+  """
+  credentials = GetCredentials()
+  if SecondsUntilRefresh(credentials, margin) == 0:
+    credentials.refresh(httplib2.Http())
+  return credentials.token_expiry
+
+
+def StartTokenRefresher(credentials):
+  """Refreshes `credentials` in a daemon thread shortly before they expire.
+
+  A missing or expiring token is refreshed first, on the calling thread, so
+  that the first API call does not refresh it at the same time.
+  """
+  if SecondsUntilRefresh(credentials) == 0:
+    try:
+      credentials.refresh(httplib2.Http())
+    except Exception:
+      pass  # The first API call refreshes again and reports the error.
+
+  def refresh_loop():
+    delay = TOKEN_REFRESH_RETRY_DELAY
+    while True:
+      if credentials.token_expiry is None:
+        # Nothing to schedule the refresh by; API calls refresh on 401.
+        time.sleep(delay)
+        delay = min(delay * 2, TOKEN_REFRESH_MAX_DELAY)
+        continue
+      time.sleep(SecondsUntilRefresh(credentials))
+      try:
+        # Use a separate connection; httplib2.Http is not thread-safe.
+        credentials.refresh(httplib2.Http())
+      except Exception:
+        pass  # The next API call refreshes synchronously, if still needed.
+      if SecondsUntilRefresh(credentials) == 0:
+        time.sleep(delay)
+        delay = min(delay * 2, TOKEN_REFRESH_MAX_DELAY)
+      else:
+        delay = TOKEN_REFRESH_RETRY_DELAY
+
+  t = threading.Thread(target=refresh_loop, name="token-refresher")
+  t.daemon = True
+  t.start()
+
+
+# -- Request Execution --
+
+class CallStats(object):
+  def __init__(self, method):
+    self.method = method
+    self.wait = 0.0  # Seconds spent in the rate limiter and in backoff.
+    self.retries = 0
+
+
+# Stats for the last CALL_STATS_MAX calls made by this process, in order.
+# Bounded, as the timer scheduler runs indefinitely.
+call_stats = collections.deque(maxlen=CALL_STATS_MAX)
+
+
+@memoize
+def GetRateLimiter():
+  return rate_limit.TokenBucket()
+
+
+def Execute(method, request, limiter=None, http=None):
+  """Executes `request` under the shared rate limit, retrying on quota and
+  transient server errors.
+  """
+  stats = CallStats(method)
+  call_stats.append(stats)
+  limiter = limiter or GetRateLimiter()
+  with profiler.span(method):
+    response = _ExecuteWithBackoff(method, request, limiter, http, stats)
+
+  if stats.retries or stats.wait >= REPORT_WAIT_THRESHOLD:
+    util.tlog("%s waited %.1fs for quota (%d retries)" %
+              (method, stats.wait, stats.retries))
+  return response
+
+
+def _ExecuteWithBackoff(method, request, limiter, http, stats):
+  payload_bytes = len(request.uri) + len(request.body or "")
+  while True:
+    with profiler.span("RateLimiter.acquire"):
+      stats.wait += limiter.acquire()
+    start = time.time()
+    try:
+      response = request.execute(http=http)
+      api_stats.record(method, time.time() - start, payload_bytes, 200)
+      return response
+    except errors.HttpError as ex:
+      status = ex.resp.status
+      api_stats.record(method, time.time() - start, payload_bytes, status)
+      retryable = RETRYABLE_STATUSES
+      if method in NON_IDEMPOTENT_METHODS:
+        retryable = (429,)
+      if status not in retryable or stats.retries >= MAX_RETRIES:
+        raise
+      if status == 429:
+        limiter.throttled()
+      delay = RetryAfter(ex.resp)
+      if delay is None:
+        delay = random.uniform(
+            0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** stats.retries))
+      stats.retries += 1
+      stats.wait += delay
+      time.sleep(delay)
+    except Exception as ex:
+      # Socket errors, timeouts, httplib2 errors; recorded as memex_daemon
+      # records RTM errors.
+      api_stats.record(method, time.time() - start, payload_bytes,
+                       type(ex).__name__)
+      raise
+
+
+def RetryAfter(response):
+  """Returns the delay requested by a Retry-After header, if any."""
+  value = response.get("retry-after")
+  if value is None:
+    return None
+  try:
+    return max(float(value), 0)
+  except ValueError:
+    pass
+  try:
+    date = email.utils.parsedate_to_datetime(value)
+  except (TypeError, ValueError):
+    return None  # Malformed; the caller backs off as usual.
+  if date.tzinfo is None:
+    date = date.replace(tzinfo=datetime.timezone.utc)  # HTTP dates are GMT.
+  return max(date.timestamp() - time.time(), 0)
+
+
 # -- Helper Functions --
 
 def col2num(col):
@@ -1,5 +1,4 @@
 import datetime
-import json
 import os
 import os.path
 import time
@@ -15,6 +14,10 @@ import util
 _config = config.Config()
 _TIME_EPSILON = 1.0  # In seconds.
 
+# Serializes read-modify-write updates of diary entries. Reads take no lock;
+# entries are replaced atomically.
+_LOCK_FILENAME = '.lock'
+
 
 def setup():
   # Initialize task manager.
@@ -33,8 +36,7 @@ def new_command(label):
     'interval_start_time': now,
     'effective': 0.0,
   }
-  with util.OpenAndLock(_resource_path(label), 'w') as f:
-    f.write(util.json_dumps(entry))
+  util.write_json_atomic(_resource_path(label), entry)
   util.tlog("diary entry with label `%s` created" % label)
 
 
@@ -45,8 +47,7 @@ def done_command(label):
     util.tlog("No diary entry with label `%s` exists" % label)
     return
 
-  with util.OpenAndLock(_resource_path(label), 'r') as f:
-    entry = json.load(f)
+  entry = util.read_json(_resource_path(label))
 
   now = time.time()
   span = now - entry['epoch']
@@ -111,12 +112,10 @@ def increment_effective(label, delta):
   if not os.path.isfile(_resource_path(label)):
     return False
 
-  with util.OpenAndLock(_resource_path(label), 'r+') as f:
-    entry = json.load(f)
+  with util.OpenAndLock(_lock_path(), 'a'):
+    entry = util.read_json(_resource_path(label))
     entry['effective'] += delta  # Can validly result in negative numbers.
-    f.truncate(0)
-    f.seek(0)
-    f.write(util.json_dumps(entry))
+    util.write_json_atomic(_resource_path(label), entry)
   return True
 
 
@@ -152,12 +151,10 @@ class Entry(object):
     # TODO(alive): rewrite with the paradigm used in timer_db.py.
     if os.path.isfile(_resource_path(self._label)):
       # TODO(alive): there's a harmless and unlikely race condition here.
-      with util.OpenAndLock(_resource_path(self._label), 'r+') as f:
-        entry = json.load(f)
+      with util.OpenAndLock(_lock_path(), 'a'):
+        entry = util.read_json(_resource_path(self._label))
         entry['interval_start_time'] = time.time()
-        f.seek(0)
-        f.truncate(0)
-        f.write(util.json_dumps(entry))
+        util.write_json_atomic(_resource_path(self._label), entry)
 
     return self
 
@@ -169,18 +166,20 @@ class Entry(object):
     """
     if os.path.isfile(_resource_path(self._label)):
       # TODO(alive): there's a harmless and unlikely race condition here.
-      with util.OpenAndLock(_resource_path(self._label), 'r+') as f:
-        entry = json.load(f)
+      with util.OpenAndLock(_lock_path(), 'a'):
+        entry = util.read_json(_resource_path(self._label))
         entry['effective'] += time.time() - entry['interval_start_time']
-        f.seek(0)
-        f.truncate(0)
-        f.write(util.json_dumps(entry))
+        util.write_json_atomic(_resource_path(self._label), entry)
 
 
 def _resource_path(name):
   return os.path.join(_config.diary_dir, name)
 
 
+def _lock_path():
+  return os.path.join(_config.diary_dir, _LOCK_FILENAME)
+
+
 def _format_timestamp(timestamp):
   datetime_obj = datetime.datetime.fromtimestamp(timestamp)
   return datetime.datetime.strftime(datetime_obj, "%H:%M:%S")
@@ -0,0 +1,192 @@
+"""Local stand-in for the parts of `rtmapi.Rtm` used by memex_daemon.
+
+Tasks are kept in memory and can be loaded from, and saved to, JSON fixtures.
+Every API call is counted and may be delayed by a fixed latency to
+approximate round trips to Remember The Milk.
+"""
+import collections
+import itertools
+import json
+import time
+
+from datetime import datetime
+
+RTM_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+class _Node(object):
+    """Attribute bag mirroring the response objects returned by rtmapi."""
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+class _TaskList(list):
+    def __init__(self, list_id, taskseries):
+        list.__init__(self, taskseries)
+        self.id = list_id
+
+
+class Rtm(object):
+    def __init__(self, api_key=None, secret=None, perms=None, token=None,
+                 latency=0.0, fixture_filepath=None):
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.lists = collections.OrderedDict()
+        self.__ids = itertools.count(1)
+
+        self.rtm = _Node(
+            tasks=_Node(getList=self.__get_list, add=self.__add,
+                        setTags=self.__set_tags, complete=self.__complete,
+                        setURL=self.__set_url,
+                        notes=_Node(add=self.__add_note)),
+            timelines=_Node(create=self.__create_timeline))
+
+        if fixture_filepath:
+            self.load_fixture(fixture_filepath)
+
+    # -- Fixtures --
+
+    def load_fixture(self, filepath):
+        with open(filepath) as f:
+            fixture = json.load(f)
+        self.lists = collections.OrderedDict(
+            (l['id'], l['taskseries']) for l in fixture['lists'])
+        self.__ids = itertools.count(fixture['next_id'])
+
+    def save_fixture(self, filepath):
+        fixture = {
+            'lists': [{'id': k, 'taskseries': v}
+                      for k, v in self.lists.items()],
+            'next_id': next(self.__ids),
+        }
+        with open(filepath, 'w') as f:
+            f.write(json.dumps(fixture, sort_keys=True, indent=2))
+
+    def add_task(self, name, list_id='1', tags=(), due=None, added=None,
+                 completed=None, priority='N', url='', notes=()):
+        """Adds a task directly to the store, without counting an API call."""
+        taskseries = {
+            'id': str(next(self.__ids)),
+            'name': name,
+            'url': url,
+            'tags': list(tags),
+            'notes': [list(n) for n in notes],
+            'task': {
+                'id': str(next(self.__ids)),
+                'due': _format_date(due),
+                'added': _format_date(added or datetime.utcnow()),
+                'completed': _format_date(completed),
+                'priority': priority,
+                'estimate': '',
+                'postponed': '0',
+            },
+        }
+        self.lists.setdefault(list_id, []).append(taskseries)
+        return taskseries
+
+    # -- API surface --
+
+    def __call(self, method):
+        self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def __get_list(self, filter=''):
+        self.__call('tasks.getList')
+        predicates = [_parse_filter_term(t) for t in filter.split(' and ')
+                      if t.strip()]
+        tasklists = []
+        for list_id, taskseries_list in self.lists.items():
+            matches = [_taskseries_node(ts) for ts in taskseries_list
+                       if all(p(ts) for p in predicates)]
+            if matches:
+                tasklists.append(_TaskList(list_id, matches))
+        return _Node(tasks=tasklists)
+
+    def __add(self, timeline, name, parse='0', list_id='1'):
+        self.__call('tasks.add')
+        fields = {'name': name}
+        if parse == '1':
+            fields = _parse_smart_add(name)
+        taskseries = self.add_task(list_id=list_id, **fields)
+        return _Node(list=_Node(
+            id=list_id,
+            taskseries=_Node(id=taskseries['id'],
+                             task=_Node(id=taskseries['task']['id']))))
+
+    def __set_tags(self, timeline, list_id, taskseries_id, task_id, tags):
+        self.__call('tasks.setTags')
+        taskseries = self.__find(list_id, taskseries_id)
+        taskseries['tags'] = [t for t in tags.split(',') if t]
+
+    def __complete(self, timeline, list_id, taskseries_id, task_id):
+        self.__call('tasks.complete')
+        taskseries = self.__find(list_id, taskseries_id)
+        taskseries['task']['completed'] = _format_date(datetime.utcnow())
+
+    def __set_url(self, timeline, list_id, taskseries_id, task_id, url):
+        self.__call('tasks.setURL')
+        self.__find(list_id, taskseries_id)['url'] = url
+
+    def __add_note(self, timeline, list_id, taskseries_id, task_id,
+                   note_title, note_text):
+        self.__call('tasks.notes.add')
+        taskseries = self.__find(list_id, taskseries_id)
+        taskseries['notes'].append([note_title, note_text])
+
+    def __create_timeline(self):
+        self.__call('timelines.create')
+        return _Node(timeline=_Node(value=str(next(self.__ids))))
+
+    def __find(self, list_id, taskseries_id):
+        for taskseries in self.lists.get(list_id, []):
+            if taskseries['id'] == taskseries_id:
+                return taskseries
+        raise Exception('fake_rtm: no taskseries %s in list %s' %
+                        (taskseries_id, list_id))
+
+
+def _format_date(date):
+    if not date:
+        return ''
+    return date.strftime(RTM_DATE_FORMAT)
+
+
+def _parse_filter_term(term):
+    key, _, value = term.strip().partition(':')
+    if key == 'tag':
+        return lambda ts: value in ts['tags']
+    if key == 'status':
+        completed = value == 'completed'
+        return lambda ts: bool(ts['task']['completed']) == completed
+    raise Exception('fake_rtm: unsupported filter term `%s`' % term)
+
+
+def _parse_smart_add(entry):
+    """Parses the subset of Smart Add syntax produced by Milk.create_task."""
+    fields = {'tags': []}
+    name = []
+    for token in entry.split(' '):
+        if token.startswith('^'):
+            # Accepts datetime.isoformat(), with or without microseconds.
+            fields['due'] = datetime.strptime(token[1:20], '%Y-%m-%dT%H:%M:%S')
+        elif token.startswith('!'):
+            fields['priority'] = token[1:]
+        elif token.startswith('='):
+            pass  # Estimates are not tracked.
+        elif token.startswith('#'):
+            fields['tags'].append(token[1:])
+        else:
+            name.append(token)
+    fields['name'] = ' '.join(name)
+    return fields
+
+
+def _taskseries_node(taskseries):
+    return _Node(
+        id=taskseries['id'],
+        name=taskseries['name'],
+        url=taskseries['url'],
+        tags=[_Node(value=t) for t in taskseries['tags']],
+        notes=[_Node(title=n[0], value=n[1]) for n in taskseries['notes']],
+        task=_Node(**taskseries['task']))
@@ -1,3 +1,6 @@
+import collections
+import datetime
+
 import walros_base
 import data_util
 from data_util import UpdateCellsMode
@@ -30,7 +33,7 @@ MONTH_COLUMN_INDICES = []
 QUARTER_COLUMN_INDICES = []
 
 
-def init_command():
+def init_tracker_data():
   tracker_data = walros_base.TrackerData()
   tracker_data.worksheet_id = WORKSHEET_ID
   tracker_data.worksheet_name = WORKSHEET_NAME
@@ -41,21 +44,75 @@ def init_command():
   tracker_data.month_column_indices = MONTH_COLUMN_INDICES
   tracker_data.quarter_column_indices = QUARTER_COLUMN_INDICES
   tracker_data.init_writes_zeros = False
+  tracker_data.build_statistics_requests = build_update_statistics_requests
+  tracker_data.compute_scores = compute_scores
+  return tracker_data
 
-  spreadsheet = data_util.Spreadsheet(walros_base.SPREADSHEET_ID)
-  worksheet = spreadsheet.GetWorksheet(tracker_data.worksheet_id)
-  init_requests = walros_base.build_init_requests(tracker_data, spreadsheet,
-                                                  worksheet)
-  if len(init_requests) == 0:
-    util.tlog("%s sheet is already initialized for today" %
-              tracker_data.worksheet_name)
-    return
 
-  # Update sheet wide statistics.
-  init_requests += build_update_statistics_requests(worksheet, tracker_data)
+def init_command(verify=False):
+  walros_base.init_trackers([init_tracker_data()], verify)
+
 
-  # Send requests.
-  response = spreadsheet.BatchUpdate(init_requests)
+def mark_command(marks):
+  """Sets today's value for each `LABEL[=VALUE]` in a single BatchUpdate."""
+  values = parse_marks(marks)
+  tracker_data = init_tracker_data()
+  spreadsheet = data_util.Spreadsheet(walros_base.SPREADSHEET_ID)
+  worksheet = spreadsheet.GetWorksheet(tracker_data.worksheet_id)
+  row = tracker_data.last_day_row_index
+
+  # The label row and today's date cell, in one read.
+  label_row = tracker_data.row_index("COLUMN_LABELS")
+  ranges = ["%s!%d:%d" % (tracker_data.worksheet_name, label_row, label_row),
+            "%s!A%d" % (tracker_data.worksheet_name, row)]
+  response = spreadsheet.GetRanges(
+      ranges, "sheets/data/rowData/values/formattedValue")
+  label_data, date_data = response["sheets"][0]["data"]
+
+  latest_date = formatted_values(date_data)[0].split(" ")[0]
+  if latest_date != datetime.datetime.now().strftime("%Y-%m-%d"):
+    util.tlog("Warning: the latest row in spreadsheet does not correspond "
+              "to today's date")
+
+  columns = habit_columns(tracker_data, formatted_values(label_data))
+  unknown = [label for label in values if label not in columns]
+  if unknown:
+    raise click.ClickException(
+        "Labels not found in spreadsheet: %s" % ", ".join(unknown))
+
+  requests = [worksheet.NewUpdateCellBatchRequest(
+                  row, columns[label], value, UpdateCellsMode.number.value)
+              for label, value in values.items()]
+  spreadsheet.BatchUpdate(requests)
+  for label, value in values.items():
+    util.tlog("%s: %g" % (label, value))
+
+
+def parse_marks(marks):
+  """Maps each label to its value; a bare label means 1."""
+  values = collections.OrderedDict()
+  for mark in marks:
+    label, _, value = mark.partition("=")
+    try:
+      values[label] = float(value) if value else 1
+    except ValueError:
+      raise click.BadParameter("%s is not a number" % value,
+                               param_hint="'%s'" % mark)
+  return values
+
+
+def habit_columns(tracker_data, labels):
+  """Maps labels in the COLUMN_LABELS row to their day column numbers."""
+  columns = {}
+  for col in tracker_data.day_column_indices[1:]:  # First is the score.
+    if col <= len(labels) and labels[col - 1]:
+      columns[labels[col - 1]] = col
+  return columns
+
+
+def formatted_values(grid_data):
+  row_data = grid_data.get("rowData", [{}])[0].get("values", [])
+  return [cell.get("formattedValue", "") for cell in row_data] or [""]
 
 
 def build_update_statistics_requests(worksheet, tracker_data):
@@ -78,3 +135,10 @@ def build_update_statistics_requests(worksheet, tracker_data):
       tracker_data.last_day_row_index, 2, score_formula,
       UpdateCellsMode.formula.value))
   return requests
+
+
+def compute_scores(header, values, named_values):
+  """Numeric counterpart of the score formula, for materialized mode."""
+  values = values.copy()
+  values[values != values] = 0  # Blank cells (NaN) count as zero.
+  return (values.sum(axis=1) / values.shape[1]) // 1
@@ -0,0 +1,174 @@
+"""Shell completion of commands, options and labels, without importing the
+rest of walrOS.
+
+Completion runs walros.py once per keystroke, so this module and walros.py's
+completion path only import click, config and util. Labels come from:
+
+  - the timer files in timer_dir and the entries in diary_dir, by filename
+    only;
+  - COLUMN_LABELS_FILEPATH, the COLUMN_LABELS rows last read from the
+    spreadsheet, so that labels without a timer can be completed too.
+
+The completion protocol is implemented here rather than with click's, which
+cannot complete argument values in the pinned click version. To enable
+completion in bash (in zsh, after `autoload bashcompinit && bashcompinit`):
+
+  eval "$(_WALROS_COMPLETE=source walros.py)"
+"""
+import json
+import os
+import sys
+
+import click
+
+import config
+import util
+
+_config = config.Config()
+
+COMPLETE_VAR = "_WALROS_COMPLETE"  # Set by the shell's completion script.
+
+_BASH_SOURCE = """\
+_%(func)s_completion() {
+  COMPREPLY=( $(env COMP_WORDS="${COMP_WORDS[*]}" COMP_CWORD=$COMP_CWORD \\
+                %(var)s=complete $1) )
+  return 0
+}
+complete -o default -F _%(func)s_completion %(prog)s
+"""
+COLUMN_LABELS_FILEPATH = "~/.walros/column_labels.json"
+
+# timer.WORKSHEET_NAME and timer_db._TIMER_FILE_SUFFIX; importing timer pulls
+# in the Google API client.
+_TIMER_WORKSHEET_NAME = "Time"
+_TIMER_FILE_SUFFIX = "-timer"
+
+
+def is_completing():
+  return COMPLETE_VAR in os.environ
+
+
+def timer_labels():
+  """Labels of the existing timers."""
+  return [f[:-len(_TIMER_FILE_SUFFIX)] for f in _listdir(_config.timer_dir)
+          if f.endswith(_TIMER_FILE_SUFFIX)]
+
+
+def diary_labels():
+  """Labels of the open diary entries."""
+  return _listdir(_config.diary_dir)
+
+
+def column_labels(worksheet_name):
+  """The worksheet's COLUMN_LABELS row as last saved, or [] if never saved."""
+  try:
+    with open(os.path.expanduser(COLUMN_LABELS_FILEPATH)) as f:
+      return json.load(f).get(worksheet_name, [])
+  except (IOError, ValueError):
+    return []
+
+
+def save_column_labels(worksheet_name, labels):
+  """Records the worksheet's COLUMN_LABELS row for completion."""
+  labels = [label for label in labels if label]
+  if column_labels(worksheet_name) == labels:
+    return
+  filepath = os.path.expanduser(COLUMN_LABELS_FILEPATH)
+  try:
+    with open(filepath) as f:
+      rows = json.load(f)
+  except (IOError, ValueError):
+    rows = {}
+  rows[worksheet_name] = labels
+  util.write_json_atomic(filepath, rows)
+
+
+def complete(group):
+  """Runs the completion request in the environment against the click
+  `group`: prints the bash script (COMPLETE_VAR=source) or the candidates
+  for the word at COMP_CWORD in COMP_WORDS (COMPLETE_VAR=complete)."""
+  prog_name = os.path.basename(sys.argv[0])
+  if os.environ[COMPLETE_VAR] == "source":
+    click.echo(_BASH_SOURCE % {
+      "func": "".join(c if c.isalnum() else "_" for c in prog_name),
+      "var": COMPLETE_VAR,
+      "prog": prog_name,
+    }, nl=False)
+    return
+
+  words = os.environ.get("COMP_WORDS", "").split()
+  cword = int(os.environ.get("COMP_CWORD", 0))
+  incomplete = words[cword] if cword < len(words) else ""
+  for candidate in candidates(group, words[1:cword], incomplete):
+    click.echo(candidate)
+
+
+def candidates(group, args, incomplete):
+  """Completions of `incomplete` after the arguments `args` of `group`."""
+  command, path, num_positional = group, (), 0
+  args = iter(args)
+  for arg in args:
+    if arg.startswith("-"):
+      option = _find_option(command, arg)
+      if option is not None and not option.is_flag:
+        next(args, None)  # The option's value.
+    elif isinstance(command, click.Group) and arg in command.commands:
+      command, path, num_positional = command.commands[arg], path + (arg,), 0
+    else:
+      num_positional += 1
+
+  if incomplete.startswith("-"):
+    return _matching([opt for param in command.params
+                      if isinstance(param, click.Option)
+                      for opt in param.opts + param.secondary_opts],
+                     incomplete)
+  if isinstance(command, click.Group):
+    return _matching(command.commands, incomplete)
+  completer = _LABEL_COMPLETERS.get(path)
+  if completer is None or num_positional:
+    return []
+  return completer(incomplete)
+
+
+# Completers of the label argument of each command.
+
+def complete_timer_start(incomplete):
+  """Existing timers and the labels of the timer worksheet."""
+  labels = set(timer_labels()) | set(column_labels(_TIMER_WORKSHEET_NAME))
+  return _matching(labels, incomplete)
+
+
+def complete_timer(incomplete):
+  return _matching(timer_labels(), incomplete)
+
+
+def complete_diary(incomplete):
+  return _matching(diary_labels(), incomplete)
+
+
+_LABEL_COMPLETERS = {
+  ("timer", "start"): complete_timer_start,
+  ("timer", "clear"): complete_timer,
+  ("diary", "done"): complete_diary,
+  ("diary", "rm"): complete_diary,
+}
+
+
+def _find_option(command, arg):
+  for param in command.params:
+    if (isinstance(param, click.Option) and
+        arg in param.opts + param.secondary_opts):
+      return param
+  return None
+
+
+def _matching(labels, incomplete):
+  return sorted(label for label in labels if label.startswith(incomplete))
+
+
+def _listdir(dirpath):
+  # Skips lock files and the temporary files of util.write_json_atomic.
+  try:
+    return [f for f in os.listdir(dirpath) if not f.startswith(".")]
+  except OSError:
+    return []
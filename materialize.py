@@ -0,0 +1,149 @@
+"""Computes tracker scores and period reductions locally.
+
+In materialized mode (the "materialized" config key), init writes the scores
+of closed days and the reductions of closed weeks, months and quarters as
+static numbers instead of formulas, so the sheet only recalculates the open
+period. `walros materialize` converts the existing history once.
+
+Values are read from the local mirror (see mirror.py). Each tracker declares
+the numeric counterparts of its formulas in its TrackerData
+(`reduce_kind`, `reduce_kind_final` and `compute_scores`).
+"""
+import collections
+
+import numpy as np
+
+import data_util
+import mirror as mirror_module
+import util
+import walros_base
+from data_util import UpdateCellsMode
+
+# Numeric counterparts of the reduce formulas. Blank cells are left out of
+# `counts`, as AVERAGE does.
+REDUCTIONS = {
+  "sum": lambda sums, counts: sums,
+  "average_if_sum":  # =IF(SUM(r), AVERAGE(r), 0)
+      lambda sums, counts: np.where(sums != 0, sums / np.maximum(counts, 1), 0),
+}
+
+
+def reduce_ranges(mirror, column, first_dates, last_dates, kind):
+  """Reduces `column` over each [first, last] date range in one pass."""
+  values = mirror.values[:, column_position(mirror, column)]
+  present = ~np.isnan(values)
+  sums = np.concatenate([[0], np.cumsum(np.where(present, values, 0))])
+  counts = np.concatenate([[0], np.cumsum(present)])
+  lo = np.searchsorted(mirror.dates, first_dates, "left")
+  hi = np.searchsorted(mirror.dates, last_dates, "right")
+  return REDUCTIONS[kind](sums[hi] - sums[lo], counts[hi] - counts[lo])
+
+
+def day_scores(tracker_data, mirror, dates):
+  """Scores of mirrored `dates`, from the tracker's `compute_scores`."""
+  rows = np.searchsorted(mirror.dates, dates)
+  cols = [column_position(mirror, c)
+          for c in tracker_data.day_column_indices[1:]]
+  header = dict((name, mirror.header[i, cols])
+                for i, name in enumerate(tracker_data.header_rows))
+  return tracker_data.compute_scores(header, mirror.values[rows][:, cols],
+                                     mirror.named)
+
+
+def build_score_requests(tracker_data, worksheet, mirror, rows, first_row,
+                         first_date):
+  """Static score updates for those `rows` whose score cell is not blank.
+
+  Sheet row `first_row` holds `first_date`; older days follow below it.
+  Scores that are not finite (e.g. a column whose goal is 0 or blank, which
+  the formula cannot score either) keep their formulas.
+  """
+  if tracker_data.compute_scores is None or not len(mirror.dates):
+    return []
+  score_col = tracker_data.day_column_indices[0]
+  rows = np.asarray(rows)
+  dates = row_dates(rows, first_row, first_date)
+  index = np.minimum(np.searchsorted(mirror.dates, dates),
+                     len(mirror.dates) - 1)
+  scored = ((mirror.dates[index] == dates) &
+            ~np.isnan(mirror.values[index, column_position(mirror,
+                                                           score_col)]))
+  with np.errstate(divide="ignore", invalid="ignore"):
+    scores = day_scores(tracker_data, mirror, dates[scored])
+  # NaN and infinity are not valid JSON; the batchUpdate would be rejected.
+  return [worksheet.NewUpdateCellBatchRequest(
+              int(row), score_col, float(score), UpdateCellsMode.number.value)
+          for row, score in zip(rows[scored], scores) if np.isfinite(score)]
+
+
+def build_reduce_requests(tracker_data, worksheet, mirror, merge_ranges,
+                          first_row, first_date):
+  """Static reduction updates for closed week, month and quarter merges."""
+  final_columns = [tracker_data.week_merge_column_indices[0],
+                   tracker_data.month_merge_column_indices[0],
+                   tracker_data.quarter_merge_column_indices[0]]
+  groups = collections.defaultdict(list)
+  for merge_range in merge_ranges:
+    col = merge_range["endColumnIndex"]
+    offset = tracker_data.reduce_column_offset(col)
+    if not offset:
+      continue  # Anchor columns hold values, not reductions.
+    kind = tracker_data.reduce_kind
+    if col in final_columns:
+      kind = tracker_data.reduce_kind_final
+    groups[(col + offset, kind)].append(
+        (merge_range["startRowIndex"] + 1, merge_range["endRowIndex"], col))
+
+  requests = []
+  for (formula_col, kind), ranges in sorted(groups.items()):
+    top, bottom, cols = (np.array(x) for x in zip(*ranges))
+    values = reduce_ranges(mirror, formula_col,
+                           row_dates(bottom, first_row, first_date),
+                           row_dates(top, first_row, first_date), kind)
+    requests += [worksheet.NewUpdateCellBatchRequest(
+                     int(row), int(col), float(value),
+                     UpdateCellsMode.number.value)
+                 for row, col, value in zip(top, cols, values)
+                 if np.isfinite(value)]
+  return requests
+
+
+def history_command(tracker_datas, plan):
+  """Replaces every closed score and reduction formula with its value."""
+  spreadsheet = data_util.Spreadsheet(walros_base.SPREADSHEET_ID)
+  for tracker_data in tracker_datas:
+    mirror, _ = mirror_module.sync(tracker_data, spreadsheet)
+    worksheet = spreadsheet.GetWorksheet(tracker_data.worksheet_id)
+    first_row = tracker_data.last_day_row_index
+    response = spreadsheet.GetRanges([tracker_data.worksheet_name],
+                                     "sheets(merges)")
+
+    # The latest day and the periods that contain it stay live.
+    merge_columns = tracker_data.all_merge_column_indices
+    closed_merges = [m for m in response["sheets"][0].get("merges", [])
+                     if m["endColumnIndex"] in merge_columns and
+                     m["startRowIndex"] + 1 > first_row]
+    rows = first_row + np.arange(1, len(mirror.dates))
+    requests = (
+        build_score_requests(tracker_data, worksheet, mirror, rows,
+                             first_row, mirror.last_date) +
+        build_reduce_requests(tracker_data, worksheet, mirror, closed_merges,
+                              first_row, mirror.last_date))
+
+    chunks = walros_base.plan_chunks(requests)
+    if plan:
+      walros_base.print_plan(tracker_data, chunks)
+      continue
+    for chunk in chunks:
+      spreadsheet.BatchUpdate(chunk)
+    util.tlog("%s: wrote %d values" % (tracker_data.worksheet_name,
+                                       len(requests)))
+
+
+def column_position(mirror, column):
+  return int(np.flatnonzero(mirror.columns == column)[0])
+
+
+def row_dates(rows, first_row, first_date):
+  """Dates of sheet `rows`; row `first_row` holds `first_date`."""
+  return np.datetime64(first_date, "D") - (np.asarray(rows) - first_row)
@@ -3,19 +3,63 @@
 import copy
 import json
 import math
+import os
 import os.path
 import random
 import re
+import time
 
 from datetime import datetime
 from datetime import timedelta
 
 from rtmapi import Rtm as rtm
 
+import api_stats
+import fake_rtm
+
 RTM_KEYS_FILEPATH = '~/.walros/memex/keys.json'
 
+# When set, init_milk targets a local fake_rtm.Rtm loaded from this fixture.
+RTM_FIXTURE_ENV = 'WALROS_RTM_FIXTURE'
+RTM_LATENCY_ENV = 'WALROS_RTM_LATENCY'  # Seconds per fake API call.
+
+MEMEX_JOURNAL_FILEPATH = '~/.walros/memex/journal.json'
+MEMEX_ZID_INDEX_FILEPATH = '~/.walros/memex/zids'
+RTM_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def _parse_rtm_date(datestr):
+    if not datestr:
+        return None
+    return datetime.strptime(datestr, RTM_DATE_FORMAT)
+
+
+def _lazy_date(attr):
+    '''A Task date that may be stored as an RTM date string, parsed on first
+    access.'''
+    def get(self):
+        value = getattr(self, attr)
+        if isinstance(value, basestring):
+            value = _parse_rtm_date(value)
+            setattr(self, attr, value)
+        return value
+
+    def set(self, value):
+        setattr(self, attr, value)
+
+    return property(get, set)
+
 
 class Task(object):
+    # Large tag:memex result sets hold many tasks; no per-instance __dict__.
+    __slots__ = ('id', 'name', '_due', '_added', 'priority', 'estimate',
+                 'postponed', '_completed', 'url', 'tags', 'notes',
+                 'list_id', 'taskseries_id', 'task_id')
+
+    due = _lazy_date('_due')
+    added = _lazy_date('_added')
+    completed = _lazy_date('_completed')
+
     def __init__(self, task_id=None, task_name=None):
         self.id = task_id
         self.name = task_name
@@ -45,21 +89,167 @@ class Task(object):
         '''All Task IDs match the pattern {prefix}[0-9]+'''
         return re.compile(r'^%s([0-9]+)$' % prefix)
 
+    def to_json_obj(self):
+        '''Fields needed to (re)create this task with Milk.create_task.'''
+        return {
+            'id': self.id,
+            'name': self.name,
+            'due': self.due.strftime(RTM_DATE_FORMAT) if self.due else None,
+            'priority': self.priority,
+            'estimate': self.estimate,
+            'url': self.url,
+            'tags': list(self.tags),
+            'notes': [list(n) for n in self.notes],
+        }
+
+    @classmethod
+    def from_json_obj(class_obj, obj):
+        task = Task(obj['id'], obj['name'])
+        if obj['due']:
+            task.due = datetime.strptime(obj['due'], RTM_DATE_FORMAT)
+        task.priority = obj['priority']
+        task.estimate = obj['estimate']
+        task.url = obj['url']
+        task.tags = obj['tags']
+        task.notes = [tuple(n) for n in obj['notes']]
+        return task
+
+
+class Journal(object):
+    '''Persists per-task memex progress so that interrupted runs can resume.
+
+    Entries are keyed by taskseries_id and hold the task's z-ID, the step it
+    reached and the follow-up task to create. They are removed as soon as a
+    task is fully processed, so the journal only ever holds in-flight work.
+    '''
+    ARCHIVING = 'archiving'  # set_tags may or may not have been applied.
+    ARCHIVED = 'archived'    # Follow-up task may or may not have been created.
+
+    def __init__(self, filepath=MEMEX_JOURNAL_FILEPATH):
+        self.__filepath = os.path.expanduser(filepath)
+        self.__entries = {}
+        if os.path.isfile(self.__filepath):
+            with open(self.__filepath) as f:
+                self.__entries = json.load(f)
+
+    def get(self, taskseries_id):
+        return self.__entries.get(taskseries_id)
+
+    def items(self):
+        return list(self.__entries.items())
+
+    def record(self, taskseries_id, z_id, state, next_task):
+        self.__entries[taskseries_id] = {
+            'z_id': z_id,
+            'state': state,
+            'next_task': next_task.to_json_obj() if next_task else None,
+        }
+        self.__flush()
+
+    def remove(self, taskseries_id):
+        if self.__entries.pop(taskseries_id, None) is not None:
+            self.__flush()
+
+    def __flush(self):
+        dirpath = os.path.dirname(self.__filepath)
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+
+        # Write to a temporary file first so a crash never truncates the
+        # journal.
+        tmp_filepath = self.__filepath + '.tmp'
+        with open(tmp_filepath, 'w') as f:
+            f.write(json.dumps(self.__entries, sort_keys=True))
+        os.rename(tmp_filepath, self.__filepath)
+
+
+class ZIdIndex(object):
+    '''The z-IDs in use, so that new ones never collide with existing tasks.
+
+    IDs are appended to the index file, one per line, as they are allocated
+    or seen on fetched tasks. A missing file is seeded from the memex-archive
+    tasks once (see `seed`). memex() adds the IDs of all memex tasks before
+    allocating any; allocating itself needs no API calls.
+    '''
+    PREFIX = 'z'
+    NUM_DIGITS = 6
+
+    def __init__(self, filepath=MEMEX_ZID_INDEX_FILEPATH):
+        self.__filepath = os.path.expanduser(filepath)
+        self.__ids = set()
+        self.exists = os.path.isfile(self.__filepath)
+        if self.exists:
+            with open(self.__filepath) as f:
+                self.__ids = set(line.strip() for line in f if line.strip())
+
+    def __contains__(self, task_id):
+        return task_id in self.__ids
+
+    def __len__(self):
+        return len(self.__ids)
+
+    def seed(self, tasks):
+        '''Adds the z-IDs tagged on `tasks` and creates the index file.'''
+        self.add_all(id_from_tags(task.tags, self.PREFIX) for task in tasks)
+        self.exists = True
+
+    def add(self, task_id):
+        self.add_all([task_id])
+
+    def add_all(self, task_ids):
+        new_ids = set(i for i in task_ids if i and i not in self.__ids)
+        if new_ids or not self.exists:
+            self.__append(sorted(new_ids))
+            self.__ids.update(new_ids)
+
+    def allocate(self):
+        '''Returns an unused z-ID and records it as used.
+
+        IDs are drawn at random until an unused one comes up, which takes
+        fewer than two draws on average while less than half are in use.
+        '''
+        capacity = 10 ** self.NUM_DIGITS
+        if len(self.__ids) >= capacity:
+            raise Exception('All %d z-IDs are in use' % capacity)
+
+        while True:
+            task_id = Task.generate_task_id(self.PREFIX, self.NUM_DIGITS)
+            if task_id not in self.__ids:
+                self.add(task_id)
+                return task_id
+
+    def __append(self, task_ids):
+        dirpath = os.path.dirname(self.__filepath)
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+
+        # Appends are flushed before the ID is tagged on a task, so a crash
+        # can only leave the index with an ID that ends up unused.
+        with open(self.__filepath, 'a') as f:
+            f.write(''.join(task_id + '\n' for task_id in task_ids))
+            f.flush()
+            os.fsync(f.fileno())
+
 
 class Milk(object):
-    def __init__(self, api_key, secret, token, perms):
-        self.__rtmapi = rtm(api_key, secret, perms, token)
+    def __init__(self, api_key, secret, token, perms, rtm_class=rtm):
+        self.__rtmapi = rtm_class(api_key, secret, perms, token)
 
     def tasks(self, selector):
-        tasks = []
-        result = self.__rtmapi.rtm.tasks.getList(filter=selector)
+        '''Yields the tasks matching `selector`, building each record lazily.
+
+        The API call is made when iteration starts, and rtmapi parses the
+        whole response before the first task is yielded; only the Task
+        records are built one at a time.
+        '''
+        result = self.__call('tasks.getList',
+                             self.__rtmapi.rtm.tasks.getList, filter=selector)
         for tasklist in result.tasks:
             for taskseries in tasklist:
                 # TODO: there can be multiple tasks per task series? wat
                 task = Task()
                 Milk.__set_fields_from_rtm(task, tasklist.id, taskseries)
-                tasks.append(task)
-        return tasks
+                yield task
 
     def create_task(self, task):
         entry = task.name
@@ -76,25 +266,28 @@ class Milk(object):
                 entry += ' #%s' % tag
 
         timeline = self.__create_timeline()
-        ret = self.__rtmapi.rtm.tasks.add(timeline=timeline, parse='1',
-                                          name=entry)
+        ret = self.__call('tasks.add', self.__rtmapi.rtm.tasks.add,
+                          timeline=timeline, parse='1', name=entry)
         task.list_id = ret.list.id
         task.taskseries_id = ret.list.taskseries.id
         task.task_id = ret.list.taskseries.task.id
 
         if task.completed:
-            self.__rtmapi.rtm.tasks.complete(
+            self.__call(
+                'tasks.complete', self.__rtmapi.rtm.tasks.complete,
                 timeline=timeline, list_id=task.list_id,
                 taskseries_id=task.taskseries_id, task_id=task.task_id)
 
         if task.url:
-            self.__rtmapi.rtm.tasks.setURL(
+            self.__call(
+                'tasks.setURL', self.__rtmapi.rtm.tasks.setURL,
                 timeline=timeline, list_id=task.list_id,
                 taskseries_id=task.taskseries_id, task_id=task.task_id,
                 url=task.url)
 
         for note in task.notes:
-            self.__rtmapi.rtm.tasks.notes.add(
+            self.__call(
+                'tasks.notes.add', self.__rtmapi.rtm.tasks.notes.add,
                 timeline=timeline, list_id=task.list_id,
                 taskseries_id=task.taskseries_id, task_id=task.task_id,
                 note_title=note[0], note_text=note[1])
@@ -107,29 +300,37 @@ class Milk(object):
             tags.append(task.id)
 
         timeline = self.__create_timeline()
-        self.__rtmapi.rtm.tasks.setTags(
+        self.__call(
+            'tasks.setTags', self.__rtmapi.rtm.tasks.setTags,
             timeline=timeline, list_id=task.list_id,
             taskseries_id=task.taskseries_id, task_id=task.task_id,
             tags=','.join(tags))
 
     def __create_timeline(self):
-        return self.__rtmapi.rtm.timelines.create().timeline.value
-
-    @classmethod
-    def __parse_rtm_date(class_obj, datestr):
-        if not datestr:
-            return None
-
-        # TODO: factor out format constant
-        return datetime.strptime(datestr, '%Y-%m-%dT%H:%M:%SZ')
+        return self.__call('timelines.create',
+                           self.__rtmapi.rtm.timelines.create).timeline.value
+
+    def __call(self, method, fn, **kwargs):
+        '''Calls an RTM API method, recording its latency in api_stats.'''
+        payload_bytes = sum(len(k) + len('%s' % v) for k, v in kwargs.items())
+        start = time.time()
+        try:
+            result = fn(**kwargs)
+        except Exception as ex:
+            api_stats.record(method, time.time() - start, payload_bytes,
+                             type(ex).__name__)
+            raise
+        api_stats.record(method, time.time() - start, payload_bytes, 'ok')
+        return result
 
     @classmethod
     def __set_fields_from_rtm(class_obj, task, list_id, rtm_taskseries):
         # TODO: these should be set to None if not set in rtm
 
+        # Dates are parsed on first access; see _lazy_date.
         task.name = rtm_taskseries.name
-        task.due = Milk.__parse_rtm_date(rtm_taskseries.task.due)
-        task.added = Milk.__parse_rtm_date(rtm_taskseries.task.added)
+        task.due = rtm_taskseries.task.due
+        task.added = rtm_taskseries.task.added
         task.priority = rtm_taskseries.task.priority
         if task.priority == 'N':
             task.priority = 4
@@ -138,15 +339,11 @@ class Milk(object):
 
         task.estimate = rtm_taskseries.task.estimate
         task.postponed = rtm_taskseries.task.postponed
-        task.completed = Milk.__parse_rtm_date(rtm_taskseries.task.completed)
+        task.completed = rtm_taskseries.task.completed
         task.url = rtm_taskseries.url
-        task.tags = []
-        for tag in rtm_taskseries.tags:
-            task.tags.append(tag.value)
-
-        task.notes = []
-        for note in rtm_taskseries.notes:
-            task.notes.append((note.title, note.value))
+        task.tags = [tag.value for tag in rtm_taskseries.tags]
+        task.notes = [(note.title, note.value)
+                      for note in rtm_taskseries.notes]
 
         # RTM specific fields
         task.list_id = list_id
@@ -154,6 +351,12 @@ class Milk(object):
         task.task_id = rtm_taskseries.task.id
 
 def init_milk():
+    fixture_filepath = os.environ.get(RTM_FIXTURE_ENV)
+    if fixture_filepath:
+        fake = fake_rtm.Rtm(latency=float(os.environ.get(RTM_LATENCY_ENV, 0)),
+                            fixture_filepath=fixture_filepath)
+        return Milk(None, None, None, 'delete', rtm_class=lambda *args: fake)
+
     # read keys; TODO: key path should be in config
     keys = None
     with open(os.path.expanduser(RTM_KEYS_FILEPATH)) as f:
@@ -175,53 +378,103 @@ def id_from_tags(tags, id_prefix):
 
     return task_id
 
-def memex(milk):
-    # TODO: factor out 'memex' tag constant
-    tasks = milk.tasks('tag:memex and status:completed')
-    interval_regex = Task.generate_task_regex('s')
+def memex(milk, journal=None, zids=None):
+    if journal is None:
+        journal = Journal()
+    if zids is None:
+        zids = ZIdIndex()
+    if not zids.exists:
+        zids.seed(milk.tasks('tag:memex-archive'))
+    # IDs chosen by a run that was interrupted before they were recorded.
+    zids.add_all(entry['z_id'] for _, entry in journal.items())
+    # Tasks later in the loop below may already carry an ID that would
+    # otherwise be allocated to an earlier one.
+    zids.add_all(id_from_tags(task.tags, ZIdIndex.PREFIX)
+                 for task in milk.tasks('tag:memex'))
 
-    for task in tasks:
+    # TODO: factor out 'memex' tag constant
+    seen = set()
+    for task in milk.tasks('tag:memex and status:completed'):
+        seen.add(task.taskseries_id)
+        memex_task(milk, journal, zids, task)
 
-        print task.name
+    # Tasks archived by an interrupted run no longer carry the memex tag and
+    # are only known to the journal.
+    for taskseries_id, entry in journal.items():
+        if taskseries_id not in seen:
+            resume_task(milk, journal, taskseries_id, entry)
 
-        # TODO: factor out prefix constant
-        task.id = id_from_tags(task.tags, 'z')
-        if not task.id:
-            task.id = Task.generate_task_id('z', 6)
 
-        # move current task to memex-archive
-        extraneous_tags = []
-        for t in task.tags:
-            if t == task.id or t == 'memex' or interval_regex.match(t):
-                continue
+def memex_task(milk, journal, zids, task):
+    interval_regex = Task.generate_task_regex('s')
 
-            extraneous_tags.append(t)
+    print task.name
+
+    # Reuse the ID chosen by an interrupted run, if any.
+    entry = journal.get(task.taskseries_id)
+    # TODO: factor out prefix constant
+    task.id = entry['z_id'] if entry else id_from_tags(task.tags, 'z')
+    if task.id:
+        zids.add(task.id)
+    else:
+        task.id = zids.allocate()
+
+    # move current task to memex-archive
+    extraneous_tags = []
+    for t in task.tags:
+        if t == task.id or t == 'memex' or interval_regex.match(t):
+            continue
 
-        archive_tags = extraneous_tags + ['memex-archive']
-        milk.set_tags(copy.deepcopy(task), archive_tags)
+        extraneous_tags.append(t)
 
-        # extract interval size from tags
-        interval = None
-        for tag in task.tags:
-            match = interval_regex.match(tag)
-            if match:
-                interval = int(match.groups()[0])
+    archive_tags = extraneous_tags + ['memex-archive']
 
-        if interval == 0:
-            # task is no longer of interest
-            continue
+    # extract interval size from tags
+    interval = None
+    for tag in task.tags:
+        match = interval_regex.match(tag)
+        if match:
+            interval = int(match.groups()[0])
 
+    next_task = None
+    if interval != 0:  # Otherwise, task is no longer of interest.
         if not interval:
             interval = 4
 
-        # create next task in review series
-        task.due = task.completed + timedelta(interval)
-        task.completed = None
-        task.tags = ['memex', 's%d' % (interval * 2)]
-        task.tags += extraneous_tags
-        task.priority = 3
+        # next task in review series
+        next_task = copy.deepcopy(task)
+        next_task.due = task.completed + timedelta(interval)
+        next_task.completed = None
+        next_task.tags = ['memex', 's%d' % (interval * 2)]
+        next_task.tags += extraneous_tags
+        next_task.priority = 3
+
+    journal.record(task.taskseries_id, task.id, Journal.ARCHIVING, next_task)
+    milk.set_tags(copy.deepcopy(task), archive_tags)
+
+    if next_task:
+        journal.record(task.taskseries_id, task.id, Journal.ARCHIVED, next_task)
+        milk.create_task(next_task)
+
+    journal.remove(task.taskseries_id)
+
+
+def resume_task(milk, journal, taskseries_id, entry):
+    if entry['next_task']:
+        next_task = Task.from_json_obj(entry['next_task'])
+
+        print next_task.name
+
+        # A crash right after create_task leaves the follow-up task in RTM
+        # while the journal still reads ARCHIVED.
+        created = (entry['state'] == Journal.ARCHIVED and
+                   any(True for _ in milk.tasks(
+                       'tag:%s and tag:memex and status:incomplete' %
+                       entry['z_id'])))
+        if not created:
+            milk.create_task(next_task)
 
-        milk.create_task(task)
+    journal.remove(taskseries_id)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,157 @@
+"""Keeps a Prometheus textfile-collector file with walrOS's state.
+
+Enabled by the "prometheus_textfile" config key: the path of a *.prom file
+in node_exporter's --collector.textfile.directory. The file is rewritten
+atomically by the timer loop (at most every TIMER_EXPORT_INTERVAL seconds),
+by init and whenever credit is written. Each export renders:
+
+  - the foreground timer, from status_segment;
+  - credit counters, pending Sheets writes and last init times, which are
+    kept in METRICS_STATE_FILEPATH since each process only sees its own;
+  - API errors, from api_stats.
+
+When the config key is not set, every function here returns immediately.
+"""
+import os
+import tempfile
+import threading
+import time
+
+import api_stats
+import config
+import status_segment
+import util
+
+_config = config.Config()
+_TEXTFILE_FILEPATH = _config.prometheus_textfile
+
+METRICS_STATE_FILEPATH = "~/.walros/metrics.json"
+TIMER_EXPORT_INTERVAL = 15  # Seconds.
+
+_last_export = 0.0
+# File locks are per process; this also serializes threads (timer_scheduler).
+_thread_lock = threading.Lock()
+
+
+def enabled():
+  return _TEXTFILE_FILEPATH is not None
+
+
+def record_credit(label, credit):
+  """Counts `credit` written to the spreadsheet for `label`."""
+  if not enabled():
+    return
+  def update(state):
+    credits = state.setdefault("credits", {}).setdefault(label, [0, 0.0])
+    credits[0] += 1
+    credits[1] += credit
+  _update_and_export(update)
+
+
+def record_init(worksheet_name):
+  """Records a successful init of the worksheet."""
+  if not enabled():
+    return
+  def update(state):
+    state.setdefault("init_times", {})[worksheet_name] = time.time()
+  _update_and_export(update)
+
+
+def set_pending_writes(worksheet_name, num_requests):
+  """Records how many requests of an init backfill remain to be sent."""
+  if not enabled():
+    return
+  def update(state):
+    state.setdefault("pending_writes", {})[worksheet_name] = num_requests
+  _update_and_export(update)
+
+
+def export(min_interval=0):
+  """Rewrites the textfile, unless this process did so within `min_interval`
+  seconds."""
+  if not enabled() or time.time() - _last_export < min_interval:
+    return
+  _update_and_export(None)
+
+
+def render(state, timer, api_counts):
+  """Returns the textfile contents for the metrics state, the status_segment
+  state `timer` and api_stats.status_counts() `api_counts`."""
+  lines = []
+  def metric(name, kind, description, samples):
+    lines.append("# HELP %s %s" % (name, description))
+    lines.append("# TYPE %s %s" % (name, kind))
+    for labels, value in samples:
+      labels = ",".join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+      lines.append("%s%s %r" % (name, "{%s}" % labels if labels else "",
+                                value))
+
+  timer_labels = [("label", timer["label"])] if timer["label"] else []
+  metric("walros_timer_running", "gauge",
+         "Whether the foreground timer is running.",
+         [(timer_labels, int(timer["running"]))])
+  metric("walros_timer_remaining_seconds", "gauge",
+         "Seconds left on the foreground timer.",
+         [(timer_labels, timer["remaining"])])
+  metric("walros_timer_interruptions", "gauge",
+         "Interruptions of the foreground timer.",
+         [(timer_labels, timer["interruptions"])])
+
+  credits = sorted(state.get("credits", {}).items())
+  metric("walros_credit_writes_total", "counter",
+         "Timer credits written to the spreadsheet.",
+         [([("label", label)], n) for label, (n, _) in credits])
+  metric("walros_credits_total", "counter",
+         "Sum of the timer credits written to the spreadsheet.",
+         [([("label", label)], total) for label, (_, total) in credits])
+  metric("walros_sheets_pending_writes", "gauge",
+         "Requests of interrupted init backfills not yet sent.",
+         [([("worksheet", name)], n)
+          for name, n in sorted(state.get("pending_writes", {}).items())])
+  metric("walros_init_last_success_timestamp_seconds", "gauge",
+         "Time of the last successful init.",
+         [([("worksheet", name)], t)
+          for name, t in sorted(state.get("init_times", {}).items())])
+  metric("walros_api_errors_total", "counter",
+         "Sheets and RTM API calls that failed, by method and status.",
+         [([("method", method), ("status", status)], n)
+          for (method, status), n in sorted(api_counts.items())
+          if status not in ("200", "ok")])
+  return "\n".join(lines) + "\n"
+
+
+def _update_and_export(update):
+  global _last_export
+  state_filepath = os.path.expanduser(METRICS_STATE_FILEPATH)
+  # Serializes updates, and keeps an export from overwriting a newer one.
+  with _thread_lock, util.OpenAndLock(state_filepath + ".lock", "a"):
+    state = {}
+    if os.path.isfile(state_filepath):
+      state = util.read_json(state_filepath)
+    if update is not None:
+      update(state)
+      util.write_json_atomic(state_filepath, state)
+    timer = status_segment.read() or {
+        "label": None, "running": False, "remaining": 0, "interruptions": 0}
+    contents = render(state, timer, api_stats.status_counts())
+    _write_atomic(_TEXTFILE_FILEPATH, contents)
+  _last_export = time.time()
+
+
+def _write_atomic(filepath, contents):
+  # node_exporter would otherwise read partial files.
+  dirpath, filename = os.path.split(filepath)
+  fd, tmp_filepath = tempfile.mkstemp(dir=dirpath, prefix="." + filename + ".")
+  try:
+    with os.fdopen(fd, "w") as f:
+      f.write(contents)
+    os.chmod(tmp_filepath, 0o644)  # node_exporter may run as another user.
+  except:
+    os.remove(tmp_filepath)
+    raise
+  os.replace(tmp_filepath, filepath)
+
+
+def _escape(value):
+  return (str(value).replace("\\", "\\\\").replace("\"", "\\\"")
+          .replace("\n", "\\n"))
@@ -0,0 +1,170 @@
+"""Local columnar copy of the tracker worksheets' day rows.
+
+Each worksheet is stored in MIRROR_DIRPATH as one .npz file holding the
+dates of its day rows (oldest first), the values of its anchor columns as a
+float matrix (NaN for empty cells), its header rows and the named ranges
+listed in the tracker's `named_ranges`. Syncing only fetches
+the rows from the last mirrored date onwards; that date is fetched again
+because its values change during the day.
+"""
+import datetime
+import os
+
+import click
+import numpy as np
+
+import data_util
+import util
+import walros_base
+
+MIRROR_DIRPATH = "~/.walros/mirror"
+
+
+class Mirror(object):
+  def __init__(self, dates, columns, labels, header, values, named):
+    self.dates = dates  # datetime64[D], ascending.
+    self.columns = columns  # Sheet column numbers of the mirrored columns.
+    self.labels = labels  # COLUMN_LABELS entries of those columns.
+    self.header = header  # Header rows x columns; NaN where not a number.
+    self.values = values  # Day rows x columns; NaN for empty cells.
+    self.named = named  # Named range -> its (first) numeric value.
+
+  @property
+  def last_date(self):
+    return self.dates[-1].astype(datetime.date) if len(self.dates) else None
+
+  def column(self, label):
+    """Returns the values of the column labeled `label`, or None."""
+    matches = np.flatnonzero(self.labels == label)
+    if not len(matches):
+      return None
+    return self.values[:, matches[0]]
+
+  @classmethod
+  def load(cls, tracker_data):
+    filepath = mirror_filepath(tracker_data)
+    if not os.path.isfile(filepath):
+      return None
+    with np.load(filepath) as f:
+      if (str(f["spreadsheet_id"]) != walros_base.SPREADSHEET_ID or
+          "named_names" not in f.files):
+        return None  # Resync from scratch.
+      named = dict(zip(f["named_names"].tolist(),
+                       f["named_values"].tolist()))
+      return cls(f["dates"], f["columns"], f["labels"], f["header"],
+                 f["values"], named)
+
+  def save(self, tracker_data):
+    filepath = mirror_filepath(tracker_data)
+    if not os.path.isdir(os.path.dirname(filepath)):
+      os.makedirs(os.path.dirname(filepath))
+    tmp_filepath = filepath + ".tmp"
+    with open(tmp_filepath, "wb") as f:
+      np.savez(f, spreadsheet_id=walros_base.SPREADSHEET_ID,
+               dates=self.dates, columns=self.columns, labels=self.labels,
+               header=self.header, values=self.values,
+               named_names=np.array(list(self.named), dtype=str),
+               named_values=np.array(list(self.named.values()), dtype=float))
+    os.replace(tmp_filepath, filepath)
+
+
+def sync(tracker_data, spreadsheet, full=False):
+  """Brings the worksheet's mirror up to date. Returns (mirror, rows read)."""
+  mirror = None if full else Mirror.load(tracker_data)
+  name = tracker_data.worksheet_name
+  columns = np.array(sorted(tracker_data.all_anchor_column_indices))
+  last_col = walros_base.col_num_to_letter(columns.max())
+  first_row = tracker_data.last_day_row_index
+
+  named_ranges = tracker_data.named_ranges
+  response = spreadsheet.GetValues(
+      ["%s!1:%d" % (name, tracker_data.row_margin),
+       "%s!A%d" % (name, first_row)] + named_ranges)
+  header_rows, latest_rows = response[:2]
+  named = dict((n, cells_to_matrix(rows, [1], 1)[0, 0])
+               for n, rows in zip(named_ranges, response[2:]))
+  latest_date = parse_date(latest_rows[0][0]) if latest_rows else None
+  if latest_date is None:
+    raise click.ClickException("%s sheet has no day rows" % name)
+  header = cells_to_matrix(header_rows, columns, tracker_data.row_margin)
+  labels_row = header_rows[tracker_data.row_index("COLUMN_LABELS") - 1]
+  labels = np.array([str(labels_row[c - 1]) if c <= len(labels_row) else ""
+                     for c in columns])
+
+  if (mirror is not None and mirror.last_date is not None and
+      mirror.last_date <= latest_date and
+      np.array_equal(mirror.columns, columns)):
+    # Day rows are ordered newest first; row `first_row` is `latest_date`.
+    last_row = first_row + (latest_date - mirror.last_date).days
+    keep = mirror.dates < np.datetime64(mirror.last_date)
+    old_dates, old_values = mirror.dates[keep], mirror.values[keep]
+  else:
+    last_row = ""  # Open-ended: every day row.
+    old_dates = np.array([], dtype="datetime64[D]")
+    old_values = np.empty((0, len(columns)))
+
+  rows = spreadsheet.GetValues(
+      ["%s!A%d:%s%s" % (name, first_row, last_col, last_row)])[0]
+  rows = [row for row in rows if row and parse_date(row[0])]
+  rows.reverse()  # Oldest first.
+  dates = np.array([parse_date(row[0]) for row in rows],
+                   dtype="datetime64[D]")
+  values = cells_to_matrix(rows, columns, len(rows))
+
+  mirror = Mirror(np.concatenate([old_dates, dates]), columns, labels,
+                  header, np.concatenate([old_values, values]), named)
+  mirror.save(tracker_data)
+  return mirror, len(rows)
+
+
+def sync_command(tracker_datas, full):
+  spreadsheet = data_util.Spreadsheet(walros_base.SPREADSHEET_ID)
+  for tracker_data in tracker_datas:
+    mirror, num_rows = sync(tracker_data, spreadsheet, full)
+    util.tlog("%s: fetched %d rows, %d mirrored through %s" % (
+        tracker_data.worksheet_name, num_rows, len(mirror.dates),
+        mirror.last_date))
+
+
+def show_command(tracker_datas, label, days):
+  for tracker_data in tracker_datas:
+    mirror = Mirror.load(tracker_data)
+    if mirror is None:
+      continue
+    column = mirror.column(label)
+    if column is None:
+      continue
+    dates, column = mirror.dates[-days:], column[-days:]
+    for date, value in zip(dates, column):
+      click.echo("  %s  %s" % (date, "" if np.isnan(value) else "%g" % value))
+    total = np.nansum(column)
+    click.echo("  total: %g, mean: %.2f over %d days" % (
+        total, total / max(len(column), 1), len(column)))
+    return
+  raise click.ClickException(
+      "Label %s not found in the mirror; run `walros mirror sync`." % label)
+
+
+def mirror_filepath(tracker_data):
+  return os.path.join(os.path.expanduser(MIRROR_DIRPATH),
+                      "%s.npz" % tracker_data.worksheet_name)
+
+
+def parse_date(cell):
+  try:
+    return datetime.datetime.strptime(
+        str(cell), walros_base.DATE_FORMAT).date()
+  except ValueError:
+    return None
+
+
+def cells_to_matrix(rows, columns, num_rows):
+  """Values of `columns` (1-based) in `rows`, with NaN for non-numbers."""
+  matrix = np.full((num_rows, len(columns)), np.nan)
+  for i, row in enumerate(rows[:num_rows]):
+    for j, col in enumerate(columns):
+      if col <= len(row):
+        cell = row[col - 1]
+        if isinstance(cell, (int, float)) and not isinstance(cell, bool):
+          matrix[i, j] = cell
+  return matrix
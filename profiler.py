@@ -0,0 +1,108 @@
+"""Records nested timing spans and writes them as a Chrome trace-event file.
+
+Spans are only recorded once `enable()` has been called. Until then, `span()`
+returns a shared no-op context manager, so instrumented code pays a function
+call and a global lookup.
+"""
+import collections
+import functools
+import json
+import os
+import threading
+import time
+
+_enabled = False
+_events = []  # (name, start, end, thread id, args)
+
+
+class _Span(object):
+  __slots__ = ("name", "args", "start")
+
+  def __init__(self, name, args):
+    self.name = name
+    self.args = args
+    self.start = None
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, *args):
+    add_span(self.name, self.start, time.time(), self.args)
+
+
+class _NullSpan(object):
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def enable():
+  global _enabled
+  _enabled = True
+
+
+def is_enabled():
+  return _enabled
+
+
+def span(name, **args):
+  if not _enabled:
+    return _NULL_SPAN
+  return _Span(name, args)
+
+
+def traced(name):
+  """Decorator recording a span around each call of the decorated function."""
+  def decorator(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+      with span(name):
+        return fn(*args, **kwargs)
+    return wrapper
+  return decorator
+
+
+def add_span(name, start, end, args=None):
+  """Records a span measured by the caller (e.g. before enable() was called).
+  """
+  if _enabled:
+    _events.append((name, start, end, threading.get_ident(), args))
+
+
+def write_trace(filepath):
+  pid = os.getpid()
+  trace_events = []
+  for name, start, end, tid, args in _events:
+    trace_events.append({
+      "name": name,
+      "ph": "X",  # Complete event.
+      "ts": start * 1e6,  # Microseconds.
+      "dur": (end - start) * 1e6,
+      "pid": pid,
+      "tid": tid,
+      "args": args or {},
+    })
+  with open(filepath, "w") as f:
+    json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+
+
+def summary():
+  """Returns (name, count, total seconds) per span name, slowest first."""
+  counts = collections.Counter()
+  totals = collections.Counter()
+  for name, start, end, _, _ in _events:
+    counts[name] += 1
+    totals[name] += end - start
+  return [(name, counts[name], total) for name, total in totals.most_common()]
+
+
+def spans(name):
+  """Returns (seconds, args) for each recorded span called `name`."""
+  return [(end - start, args) for n, start, end, _, args in _events
+          if n == name]
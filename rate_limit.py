@@ -0,0 +1,80 @@
+import json
+import os
+import threading
+import time
+
+import util
+
+# Token bucket state shared by every walrOS process on this machine.
+RATE_LIMIT_FILEPATH = "~/.walros/sheets_rate_limit.json"
+
+# Sheets allows 60 read and 60 write requests per minute per user.
+DEFAULT_RATE = 1.0  # Requests per second.
+DEFAULT_BURST = 10  # Requests.
+
+# On every 429 the shared rate is halved, then recovers linearly to the
+# default rate over RATE_RECOVERY_PERIOD.
+RATE_BACKOFF_FACTOR = 0.5
+MIN_RATE = 0.05  # Requests per second.
+RATE_RECOVERY_PERIOD = 120.0  # Seconds.
+
+
+class TokenBucket(object):
+  """Token bucket coordinated across processes through a locked state file.
+  """
+
+  def __init__(self, filepath=RATE_LIMIT_FILEPATH, rate=DEFAULT_RATE,
+               burst=DEFAULT_BURST):
+    self.filepath_ = os.path.expanduser(filepath)
+    self.rate_ = rate
+    self.burst_ = burst
+    self.lock_ = threading.Lock()  # lockf does not exclude our own threads.
+
+  def acquire(self):
+    """Blocks until a request may be sent. Returns the seconds waited."""
+    waited = 0.0
+    while True:
+      delay = self._update(self._take)
+      if delay == 0:
+        return waited
+      time.sleep(delay)
+      waited += delay
+
+  def throttled(self):
+    """Records a 429 response, slowing down every process sharing the file."""
+    self._update(self._throttle)
+
+  def _take(self, state, now):
+    rate = self._effective_rate(state, now)
+    tokens = min(self.burst_,
+                 state["tokens"] + (now - state["updated"]) * rate)
+    state["updated"] = now
+    if tokens >= 1:
+      state["tokens"] = tokens - 1
+      return 0
+    state["tokens"] = tokens
+    return (1 - tokens) / rate
+
+  def _throttle(self, state, now):
+    self._take(state, now)  # Bring the token count up to date.
+    state["throttled_rate"] = max(
+        MIN_RATE, self._effective_rate(state, now) * RATE_BACKOFF_FACTOR)
+    state["throttled_at"] = now
+    state["tokens"] = 0.0
+
+  def _effective_rate(self, state, now):
+    elapsed = now - state.get("throttled_at", 0)
+    recovered = elapsed * self.rate_ / RATE_RECOVERY_PERIOD
+    return min(self.rate_, state.get("throttled_rate", self.rate_) + recovered)
+
+  def _update(self, update_fn):
+    with self.lock_, util.OpenAndLock(self.filepath_, 'a+') as f:
+      f.seek(0)
+      contents = f.read()
+      now = time.time()
+      state = (json.loads(contents) if contents else
+               {"tokens": float(self.burst_), "updated": now})
+      result = update_fn(state, now)
+      f.truncate(0)
+      f.write(json.dumps(state))
+    return result
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""Publishes the foreground timer's state in a small memory-mapped file.
+
+Status bars poll the timer every second. Rather than scanning timer_db, they
+read SEGMENT_FILENAME in timer_dir, which the running timer loop keeps up to
+date: a fixed-size header and record (see _HEADER and _RECORD), written
+under a sequence lock so that readers never take a lock and retry if they
+catch a write in progress.
+
+Run as a script, this module prints the state as JSON (see `read()`) using
+only the standard library and config.py, for status bars:
+
+  python3 status_segment.py
+"""
+import fcntl
+import json
+import mmap
+import os
+import struct
+import time
+
+import config
+
+SEGMENT_FILENAME = ".status"
+_MAGIC = b"wtst"
+_VERSION = 1
+_LABEL_MAX_BYTES = 128
+_READ_ATTEMPTS = 100
+
+# Magic, version, sequence. The sequence is odd while a write is in progress.
+_HEADER = struct.Struct("<4sIQ")
+# Time of the write, endtime (0 if paused), remaining seconds when paused,
+# interruptions, pid of the writer, label length and label (UTF-8).
+_RECORD = struct.Struct("<dddIIH%ds" % _LABEL_MAX_BYTES)
+_SEGMENT_BYTES = 256
+
+assert _HEADER.size + _RECORD.size <= _SEGMENT_BYTES
+
+_fd = None  # Segment file and its mmap, opened by the first write.
+_segment = None
+
+
+def publish(label, endtime, remaining, interruptions):
+  """Records `label` as the foreground timer; paused if `endtime` is 0."""
+  _write(label, endtime, remaining, interruptions)
+
+
+def clear(label):
+  """Records that no foreground timer exists, if the segment shows `label`."""
+  state = read()
+  if state and state["label"] == label:
+    _write("", 0, 0, 0)
+
+
+def read():
+  """Returns the published state as a dict, or None if writes kept racing.
+
+  Keys are `label` (None when no timer is shown), `running`, `endtime`,
+  `remaining` (seconds, as of now), `interruptions` and `updated` (time of
+  the last write, 0 if never written). A running timer whose process has
+  exited is reported as not running.
+  """
+  idle = {"label": None, "running": False, "endtime": 0, "remaining": 0,
+          "interruptions": 0, "updated": 0}
+  try:
+    with open(segment_filepath(), "rb") as f:
+      segment = mmap.mmap(f.fileno(), _SEGMENT_BYTES, access=mmap.ACCESS_READ)
+  except (IOError, OSError, ValueError):
+    return idle
+
+  with segment:
+    for _ in range(_READ_ATTEMPTS):
+      magic, version, sequence = _HEADER.unpack_from(segment, 0)
+      if magic != _MAGIC or version != _VERSION:
+        return idle
+      if sequence % 2:
+        continue  # A write is in progress.
+      record = _RECORD.unpack_from(segment, _HEADER.size)
+      if _HEADER.unpack_from(segment, 0)[2] == sequence:
+        break
+    else:
+      return None
+
+  updated, endtime, remaining, interruptions, pid, length, label = record
+  label = label[:length].decode("utf-8") or None
+  running = bool(label and endtime and _is_alive(pid))
+  if running:
+    remaining = endtime - time.time()
+  return {
+    "label": label,
+    "running": running,
+    "endtime": endtime if running else 0,
+    "remaining": int(round(remaining)) if label else 0,
+    "interruptions": interruptions,
+    "updated": updated,
+  }
+
+
+def segment_filepath():
+  return os.path.join(config.Config().timer_dir, SEGMENT_FILENAME)
+
+
+def _write(label, endtime, remaining, interruptions):
+  global _fd, _segment
+  if _segment is None:
+    _fd = os.open(segment_filepath(), os.O_RDWR | os.O_CREAT, 0o644)
+    if os.fstat(_fd).st_size < _SEGMENT_BYTES:
+      os.ftruncate(_fd, _SEGMENT_BYTES)
+    _segment = mmap.mmap(_fd, _SEGMENT_BYTES)
+
+  label = label.encode("utf-8")[:_LABEL_MAX_BYTES]
+  record = _RECORD.pack(time.time(), endtime, remaining, interruptions,
+                        os.getpid(), len(label), label)
+  # Writers are rare; a file lock keeps them from interleaving.
+  fcntl.lockf(_fd, fcntl.LOCK_EX)
+  try:
+    _, _, sequence = _HEADER.unpack_from(_segment, 0)
+    sequence += 1 + sequence % 2  # Next odd number.
+    _HEADER.pack_into(_segment, 0, _MAGIC, _VERSION, sequence)
+    _segment[_HEADER.size:_HEADER.size + _RECORD.size] = record
+    _HEADER.pack_into(_segment, 0, _MAGIC, _VERSION, sequence + 1)
+  finally:
+    fcntl.lockf(_fd, fcntl.LOCK_UN)
+
+
+def _is_alive(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    pass
+  return True
+
+
+if __name__ == "__main__":
+  print(json.dumps(read(), sort_keys=True))
@@ -1,6 +1,8 @@
+import asyncio
 import datetime
 import fcntl
 import itertools
+import json
 import os
 import os.path
 import platform
@@ -12,12 +14,14 @@ import time
 
 import click
 
-from oauth2client.service_account import ServiceAccountCredentials
-
 import config
 import data_util
 import diary
+import label_index
+import metrics
+import status_segment
 import timer_db
+import timer_scheduler
 import util
 import walros_base
 
@@ -52,6 +56,11 @@ FOCUS_UNIT_DURATION = 1800  # Seconds (30 minutes).
 BASE_INTERRUPTION_PENALTY = 0.04 # Time units
 SPREADSHEET_KEY_FILEPATH = os.path.expanduser("~/.walros/keys.json")
 
+# Foreground timers fetch what crediting them needs while they run (see
+# CountPrefetch).
+PREFETCH_LEAD = 60  # Seconds before the end at which the fetch is repeated.
+PREFETCH_MAX_AGE = 180  # Seconds. Older lookups are repeated before writing.
+
 # Signals.
 SIGNALS_SUBDIR = ".signals"
 TIMER_RUNNING_SIGNAL = "timer_running"
@@ -79,25 +88,15 @@ def init_tracker_data():
   tracker_data.day_column_indices = DAY_COLUMN_INDICES
   tracker_data.reduce_formula_final =\
     lambda r: "=IF(SUM(%s), AVERAGE(%s), 0)" % (r, r)
+  tracker_data.build_statistics_requests = build_update_statistics_requests
+  tracker_data.reduce_kind_final = "average_if_sum"
+  tracker_data.compute_scores = compute_scores
+  tracker_data.named_ranges = ["TimeMaxScore"]
   return tracker_data
 
 
-def init_command():
-  tracker_data = init_tracker_data()
-  spreadsheet = data_util.Spreadsheet(walros_base.SPREADSHEET_ID)
-  worksheet = spreadsheet.GetWorksheet(tracker_data.worksheet_id)
-  init_requests = walros_base.build_init_requests(tracker_data, spreadsheet,
-                                                  worksheet)
-  if len(init_requests) == 0:
-    util.tlog("%s sheet is already initialized for today" %
-              tracker_data.worksheet_name)
-    return
-
-  # Update sheet wide statistics.
-  init_requests += build_update_statistics_requests(worksheet, tracker_data)
-
-  # Send requests.
-  response = spreadsheet.BatchUpdate(init_requests)
+def init_command(verify=False):
+  walros_base.init_trackers([init_tracker_data()], verify)
 
 # TODO(alive): move sheets logic into separate module.
 def build_update_statistics_requests(worksheet, tracker_data):
@@ -122,94 +121,172 @@ def build_update_statistics_requests(worksheet, tracker_data):
   return requests
 
 
+def compute_scores(header, values, named_values):
+  """Numeric counterpart of the final score formula, for materialized mode."""
+  values, weights = values.copy(), header["WEIGHTS"].copy()
+  values[values != values] = 0  # Blank cells (NaN) count as zero.
+  weights[weights != weights] = 0
+  progress = (values / header["GOAL_NUMBER"]).clip(
+      max=named_values["TimeMaxScore"])
+  return (weights * progress).sum(axis=1)
+
+
 def start_command(label, seconds, minutes, hours, whitenoise, count, track,
-                  force):
-  tracker_data = init_tracker_data()
+                  force, scheduled=False):
+  if not seconds and not minutes and not hours:
+    seconds = FOCUS_UNIT_DURATION * count
+  if scheduled:
+    schedule_command(label, seconds, minutes, hours, count, track, force)
+    return
+
   if not set_signal(TIMER_RUNNING_SIGNAL):
     util.tlog("A timer is already running")
     return
 
-  clear_signals(exclude=[TIMER_RUNNING_SIGNAL])
-  if not seconds and not minutes and not hours:
-    seconds = FOCUS_UNIT_DURATION * count
+  try:  # Any failure past this point must release the signal.
+    clear_signals(exclude=[TIMER_RUNNING_SIGNAL])
+    with timer_db.Transaction() as txn:
+      # e.g. a scheduled timer; it is left to the scheduler.
+      if txn.timer_exists(label) and txn.timer(label).is_running:
+        util.tlog("The timer with label `%s` is already running" % label)
+        return
+      start_or_resume(txn, label, seconds, minutes, hours, force)
+
+    prefetch = CountPrefetch(init_tracker_data(), label) if track else None
+    published = None
+    try:
+      with diary.Entry(label):  # Tracks effective time spent and overhead.
+        while True:  # Timer loop.
+          # end time could have been changed; read again from file
+          with timer_db.TimerFileProxy(label, read_only=True) as timer:
+            if timer.is_complete:
+              util.tlog("Timer `%s` completed" % timer.label)
+              break
+            if published != (timer.endtime, timer.interruptions):
+              published = (timer.endtime, timer.interruptions)
+              status_segment.publish(label, timer.endtime, timer.remaining,
+                                     timer.interruptions)
+            metrics.export(metrics.TIMER_EXPORT_INTERVAL)
+            if unset_signal(DISPLAY_UPDATE_SIGNAL):
+              util.tlog("Currently at %d seconds" % timer.remaining)
+            if prefetch and timer.remaining <= PREFETCH_LEAD:
+              prefetch.refresh()
+          time.sleep(1)
+    finally:
+      with timer_db.TimerFileProxy(label) as timer:
+        if not timer.is_complete:
+          remaining = timer.pause()
+          status_segment.publish(label, 0, remaining, timer.interruptions)
+          metrics.export()
+          util.tlog("Pausing timer at %d seconds" % remaining, prefix='\n')
+  finally:
+    unset_signal(TIMER_RUNNING_SIGNAL)
 
-  if force and timer_db.timer_exists(label):
-    with timer_db.TimerFileProxy(label) as timer:
-      timer.clear()
+  complete_timer(label, count, track, prefetch)
 
-  if timer_db.timer_exists(label):
-    with timer_db.TimerFileProxy(label) as timer:
-      timer.resume()
-      util.tlog("Resuming at %d seconds" % timer.remaining)
 
+def schedule_command(label, seconds, minutes, hours, count, track, force):
+  """Starts a timer owned by the scheduler process and returns immediately."""
+  with timer_db.Transaction() as txn:
+    if txn.timer_exists(label) and txn.timer(label).is_running:
+      util.tlog("The timer with label `%s` is already running" % label)
+      return
+    start_or_resume(txn, label, seconds, minutes, hours, force,
+                    schedule=(count, track))
+
+  if not timer_scheduler.wake():
+    util.tlog("No scheduler is running; start one with "
+              "`walros timer scheduler`")
+
+
+def start_or_resume(txn, label, seconds, minutes, hours, force,
+                    schedule=None):
+  if force and txn.timer_exists(label):
+    txn.timer(label).clear()
+
+  resume = txn.timer_exists(label)
+  timer = txn.timer(label)
+  if schedule:
+    timer.schedule(*schedule)
   else:
-    with timer_db.TimerFileProxy(label) as timer:
-      timer.start(seconds, minutes, hours)
-      util.tlog("Starting at %d seconds" % timer.remaining)
+    timer.unschedule()
 
-  try:
-    with diary.Entry(label):  # Tracks effective time spent and overhead.
-      while True:  # Timer loop.
-        # end time could have been changed; read again from file
-        with timer_db.TimerFileProxy(label) as timer:
-          if timer.is_complete:
-            util.tlog("Timer `%s` completed" % timer.label)
-            break
-          if unset_signal(DISPLAY_UPDATE_SIGNAL):
-            util.tlog("Currently at %d seconds" % timer.remaining)
-        time.sleep(1)
-  finally:
-    with timer_db.TimerFileProxy(label) as timer:
-      if not timer.is_complete:
-        remaining = timer.pause()
-        util.tlog("Pausing timer at %d seconds" % remaining, prefix='\n')
-    unset_signal(TIMER_RUNNING_SIGNAL)
+  if resume:
+    timer.resume()
+    util.tlog("Resuming at %d seconds" % timer.remaining)
+  else:
+    timer.start(seconds, minutes, hours)
+    util.tlog("Starting at %d seconds" % timer.remaining)
+
+
+def scheduler_command():
+  def on_complete(label, count, track):
+    util.tlog("Timer `%s` completed" % label)
+    complete_timer(label, count, track)
+
+  scheduler = timer_scheduler.Scheduler(on_complete)
+  util.tlog("Timer scheduler started")
+  scheduler.run()
 
-  try:  # Timer complete, notify and record.
+
+def complete_timer(label, count, track, prefetch=None):
+  """Notifies, records credit for a completed timer, and clears it.
+
+  `prefetch` is the timer's CountPrefetch, if one ran during the countdown.
+  """
+  try:
     timer_notify()
 
     if track:
-      with timer_db.TimerFileProxy(label) as timer:
-        spreadsheet = data_util.Spreadsheet(walros_base.SPREADSHEET_ID)
-        worksheet = spreadsheet.GetWorksheet(tracker_data.worksheet_id)
-        latest_date = spreadsheet.GetCellValue(
-            worksheet_name=tracker_data.worksheet_name,
-            row=tracker_data.row_margin + 1, col=1)
-        latest_date = latest_date.split()[0]
-        date_today = datetime.datetime.now().strftime("%Y-%m-%d")
-        if latest_date != date_today:
-          util.tlog("Warning: the latest row in spreadsheet does not correspond "
-                    "to today's date")
-
-        credit = count
-        timer_interruptions = timer.interruptions
-        while timer_interruptions > 0:
-          # Impose exponential cost to interruptions.
-          timer_interruptions -= 1
-          credit -= BASE_INTERRUPTION_PENALTY * 2 ** timer_interruptions
-        credit = max(credit, 0)
-
-        label_count = timer_increment_label_count(
-            spreadsheet, worksheet, tracker_data, label, credit)
-        util.tlog("interruptions: %d, credit: %.2f" %
-                  (timer.interruptions, credit))
-        util.tlog("%s count: %.2f" % (label, label_count))
-        timer.clear()
+      with timer_db.TimerFileProxy(label, read_only=True) as timer:
+        interruptions = timer.interruptions
+      credit = timer_credit(count, interruptions)
+
+      # Not holding the timer lock during API calls.
+      if prefetch:
+        label_count = prefetch.increment(credit)
+      else:
+        label_count = asyncio.run(
+            timer_increment_label_count(init_tracker_data(), label, credit))
+      metrics.record_credit(label, credit)
+      util.tlog("interruptions: %d, credit: %.2f" % (interruptions, credit))
+      util.tlog("%s count: %.2f" % (label, label_count))
+
+    with timer_db.TimerFileProxy(label) as timer:
+      timer.clear()
+    status_segment.clear(label)
+    metrics.export()
 
   except Exception as ex:
     util.tlog("Error updating spreadsheet count")
     raise ex
 
 
+def timer_credit(count, interruptions):
+  credit = count
+  while interruptions > 0:
+    # Impose exponential cost to interruptions.
+    interruptions -= 1
+    credit -= BASE_INTERRUPTION_PENALTY * 2 ** interruptions
+  return max(credit, 0)
+
+
 def status_command(data):
+  if data:
+    # Published by the timer loop; no timer files are read.
+    click.echo(json.dumps(status_segment.read(), sort_keys=True))
+    return
+
   def timer_status_str(timer):
     return '  %s: %d' % (timer.label, timer.remaining)
-  running_timer = timer_db.running_timer()
-  if running_timer:
-    with running_timer:
+  with timer_db.Transaction(read_only=True) as txn:
+    running_timer = txn.running_timer()
+    if running_timer:
       click.secho(timer_status_str(running_timer), fg='green')
-  for timer in timer_db.existing_timers():
-    with timer:
+    for timer in txn.running_timers():
+      if timer.scheduled:
+        click.secho(timer_status_str(timer) + ' (scheduled)', fg='green')
+    for timer in txn.existing_timers():
       if timer.is_running:
         continue
       click.echo(timer_status_str(timer))
@@ -218,29 +295,46 @@ def status_command(data):
 def clear_command(label):
   if timer_db.timer_exists(label):
     with timer_db.TimerFileProxy(label) as timer:
-      if timer.is_running:
+      # Scheduled timers have no foreground process to stop them.
+      if timer.is_running and not timer.scheduled:
         util.tlog("The timer with label `%s` is currently running" %
                    timer.label)
         return
+      scheduled = timer.scheduled
       timer.clear()
+    status_segment.clear(label)
+    if scheduled:
+      timer_scheduler.wake()
   else:
     util.tlog("No paused timer with label '%s' exists" % label)
 
 
 def inc_command(delta):
-  timer = timer_db.running_timer()
-  if not timer:
-    util.tlog("No timer is currently running")
-    return
-  with timer:
+  with timer_db.Transaction() as txn:
+    # The running timers listed by status: the foreground timer if there is
+    # one, otherwise the only running scheduled timer.
+    timer = txn.running_timer()
+    running_timers = txn.running_timers()
+    if not timer and len(running_timers) > 1:
+      util.tlog("Several scheduled timers are running")
+      return
+    if not timer and running_timers:
+      timer = running_timers[0]
+    if not timer:
+      util.tlog("No timer is currently running")
+      return
     remaining = timer.remaining
     timer.inc(delta)
     click.echo("  previous: %f" % remaining)
     click.echo("  current:  %f" % timer.remaining)
     if diary.increment_effective(timer.label, -1 * delta):
       click.echo("  (diary updated)")
+    scheduled = timer.scheduled
 
-  set_signal(DISPLAY_UPDATE_SIGNAL)
+  if scheduled:
+    timer_scheduler.wake()  # Its end time moved.
+  else:
+    set_signal(DISPLAY_UPDATE_SIGNAL)
 
 
 def timer_notify():
@@ -267,13 +361,14 @@ def timer_signal_path(signal_name):
   return os.path.join(_config.timer_dir, SIGNALS_SUBDIR, signal_name)
 
 
-def timer_col_index_for_label(spreadsheet, worksheet, tracker_data, label):
+async def timer_col_index_for_label(spreadsheet, tracker_data, label):
   row_index = tracker_data.row_index("COLUMN_LABELS")
   ranges = ["%s!%d:%d" % (tracker_data.worksheet_name, row_index, row_index)]
-  response = spreadsheet.GetRanges(ranges, "sheets/data/rowData")
+  response = await spreadsheet.GetRanges(ranges, "sheets/data/rowData")
   row_data = response["sheets"][0]["data"][0]["rowData"][0]["values"]
   row_data = row_data[tracker_data.column_margin:]
   row_labels = [ col["effectiveValue"]["stringValue"] for col in row_data ]
+  label_index.save_column_labels(tracker_data.worksheet_name, row_labels)
   try:
     col_index = row_labels.index(label)
     col_index += tracker_data.column_margin + 1
@@ -283,21 +378,133 @@ def timer_col_index_for_label(spreadsheet, worksheet, tracker_data, label):
   return col_index
 
 
-def timer_increment_label_count(spreadsheet, worksheet, tracker_data, label,
-                                credit):
+async def timer_increment_label_count(tracker_data, label, credit):
+  spreadsheet = data_util.AsyncSpreadsheet(walros_base.SPREADSHEET_ID)
+  worksheet = spreadsheet.GetWorksheet(tracker_data.worksheet_id)
   row = tracker_data.row_margin + 1
-  col = timer_col_index_for_label(spreadsheet, worksheet, tracker_data, label)
-  cell_value = spreadsheet.GetCellValue(tracker_data.worksheet_name, row, col)
+
+  # The date check and the label lookup are independent; fetch both at once.
+  latest_date, col = await asyncio.gather(
+      spreadsheet.GetCellValue(tracker_data.worksheet_name, row, 1),
+      timer_col_index_for_label(spreadsheet, tracker_data, label))
+  latest_date = latest_date.split()[0]
+  date_today = datetime.datetime.now().strftime("%Y-%m-%d")
+  if latest_date != date_today:
+    util.tlog("Warning: the latest row in spreadsheet does not correspond "
+              "to today's date")
+
+  cell_value = await spreadsheet.GetCellValue(tracker_data.worksheet_name,
+                                              row, col)
   cell_value = credit if not cell_value else float(cell_value) + credit
 
   requests = []
   requests.append(worksheet.NewUpdateCellBatchRequest(
       row, col, cell_value, update_cells_mode=data_util.UpdateCellsMode.number.value))
-  spreadsheet.BatchUpdate(requests)
+  await spreadsheet.BatchUpdate(requests)
 
   return cell_value
 
 
+class CountPrefetch(object):
+  """Looks up where a label's count is while its timer counts down.
+
+  A background thread builds the Sheets service and reads the COLUMN_LABELS
+  row and the date of the latest day row in one request: once when the timer
+  starts and again on `refresh()`, which the timer loop calls PREFETCH_LEAD
+  seconds before the end. `increment()` then only reads the count and writes
+  it back, so other writes to the cell in the meantime are not lost. A lookup
+  older than PREFETCH_MAX_AGE, or made on another day or before the sheet had
+  today's row, is repeated first.
+
+  Credentials are loaded on the calling thread, since obtaining them may run
+  the interactive OAuth2 flow.
+  """
+  def __init__(self, tracker_data, label):
+    self._tracker_data = tracker_data
+    self._label = label
+    self._spreadsheet = None
+    self._fetched_at = None  # Time at which the fields below were read.
+    self._date = None  # Date of the sheet's latest day row.
+    self._col = None  # Column of `label`, or None if not in the sheet.
+    self._refreshed = False
+    self._stopped = False
+    self._wake = threading.Event()
+    self._thread = threading.Thread(target=self._run, name="count-prefetch")
+    self._thread.daemon = True
+    data_util.GetCredentials()
+    self._thread.start()
+
+  def refresh(self):
+    """Reads the rows again in the background, once."""
+    if self._refreshed:
+      return
+    self._refreshed = True
+    if (self._fetched_at is None or
+        time.time() - self._fetched_at >= PREFETCH_LEAD):
+      self._wake.set()
+
+  def increment(self, credit):
+    """Adds `credit` to today's count for the label. Returns the new count."""
+    self._stopped = True
+    self._wake.set()
+    self._thread.join()  # Waits for a fetch in progress.
+
+    today = datetime.datetime.now().strftime("%Y-%m-%d")
+    # Read on another day, or before init added today's row.
+    if (self._fetched_at is None or self._date != today or
+        time.time() - self._fetched_at > PREFETCH_MAX_AGE):
+      self._fetch()
+    if self._date != today:
+      util.tlog("Warning: the latest row in spreadsheet does not correspond "
+                "to today's date")
+    if self._col is None:
+      raise click.ClickException(
+          "Label %s not found in spreadsheet." % self._label)
+
+    tracker_data = self._tracker_data
+    row = tracker_data.row_margin + 1
+    # Read right before writing, as the count may have changed meanwhile.
+    cell, = self._spreadsheet.GetValues(["%s!%s%d" % (
+        tracker_data.worksheet_name, data_util.num2col(self._col), row)])
+    value = cell[0][0] if cell and cell[0] else None
+    value = float(value) + credit if value else credit
+    worksheet = self._spreadsheet.GetWorksheet(tracker_data.worksheet_id)
+    self._spreadsheet.BatchUpdate([worksheet.NewUpdateCellBatchRequest(
+        row, self._col, value,
+        update_cells_mode=data_util.UpdateCellsMode.number.value)])
+    return value
+
+  def _run(self):
+    while not self._stopped:
+      try:
+        self._fetch()
+      except Exception:
+        pass  # increment() fetches again and reports the error.
+      self._wake.wait()
+      self._wake.clear()
+
+  def _fetch(self):
+    tracker_data = self._tracker_data
+    if self._spreadsheet is None:
+      self._spreadsheet = data_util.Spreadsheet(walros_base.SPREADSHEET_ID)
+    name = tracker_data.worksheet_name
+    label_row = tracker_data.row_index("COLUMN_LABELS")
+    row = tracker_data.row_margin + 1
+    labels, date = self._spreadsheet.GetValues(
+        ["%s!%d:%d" % (name, label_row, label_row),
+         "%s!A%d" % (name, row)])
+    labels = [str(cell) for cell in
+              (labels[0] if labels else [])[tracker_data.column_margin:]]
+    label_index.save_column_labels(name, labels)
+
+    col = None
+    if self._label in labels:
+      col = labels.index(self._label) + tracker_data.column_margin + 1
+    self._date = str(date[0][0]).split()[0] if date and date[0] else None
+    self._col = col
+    self._fetched_at = time.time()
+
+
 # TODO(alive): move signals into separate module.
 def set_signal(signal_name):
   signal_filepath = timer_signal_path(signal_name)
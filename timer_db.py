@@ -1,8 +1,8 @@
 import functools
-import json
 import os
 import os.path
 import sys
+import threading
 import time
 
 import config
@@ -12,41 +12,157 @@ _config = config.Config()
 _TIMER_FILE_SUFFIX = '-timer'
 _DIRECTORY_PATH = _config.timer_dir
 
+# Held by every Transaction; serializes all timer mutations.
+_LOCK_FILENAME = '.lock'
+_lock_depth = 0  # Nested transactions in this process share one lock.
+# File locks are per process; this also serializes threads (timer_scheduler).
+_thread_lock = threading.RLock()
+
 
 def timer_exists(label):
   return os.path.isfile(_timer_filepath(label))
 
 
 def existing_timers():
-  filepaths = (f for f in os.listdir(_DIRECTORY_PATH)
-               if os.path.isfile(os.path.join(_DIRECTORY_PATH, f)))
-  timer_filenames = (f for f in filepaths if f.endswith(_TIMER_FILE_SUFFIX))
-  timer_names = (f[:f.rfind(_TIMER_FILE_SUFFIX)] for f in timer_filenames)
-  return (TimerFileProxy(t) for t in timer_names)
+  return (TimerFileProxy(t) for t in _existing_labels())
 
 
 def running_timer():
   '''Returns the currently running timer or None if no timer is running.'''
   # TODO(alive): re-implement in terms of signals?
-  running_timer = None
-  for timer in existing_timers():
-    with timer:
-      if timer.is_running:
-        # There should never be more than one running timer.
-        assert running_timer is None
-        running_timer = timer
-  return running_timer
+  with Transaction(read_only=True) as txn:
+    timer = txn.running_timer()
+    return TimerFileProxy(timer.label, read_only=True) if timer else None
+
+
+class Transaction(object):
+  '''Reads and mutates several timers under a single lock.
+
+  Each timer is loaded at most once. When the `with` block exits normally,
+  modified timers are written back together and cleared timers are deleted;
+  if it raises, nothing is written. Unchanged timers are neither re-read nor
+  rewritten across transactions (see util.read_json).
+
+    with timer_db.Transaction() as txn:
+      timer = txn.running_timer()
+      if timer:
+        timer.inc(60)
+
+  With `read_only`, no lock is taken and nothing is written: timers are read
+  as they are on disk (timer files are replaced atomically), and calling a
+  method that changes them raises AssertionError. Timers cleared after being
+  listed are skipped.
+  '''
+  def __init__(self, read_only=False):
+    self._timers = {}  # label -> TimerFileProxy
+    self._scanned = False
+    self._lock = None
+    self._read_only = read_only
+
+  def __enter__(self):
+    global _lock_depth
+    if self._read_only:
+      return self
+    _thread_lock.acquire()
+    try:
+      if _lock_depth == 0:
+        self._lock = util.OpenAndLock(
+            os.path.join(_DIRECTORY_PATH, _LOCK_FILENAME), 'a')
+        self._lock.__enter__()
+    except:
+      _thread_lock.release()
+      raise
+    _lock_depth += 1
+    return self
+
+  def __exit__(self, exc_type, *args):
+    global _lock_depth
+    if self._read_only:
+      for timer in self._timers.values():
+        timer._enter_called = False
+      return
+    try:
+      if exc_type is None:
+        self._commit()
+    finally:
+      for timer in self._timers.values():
+        timer._enter_called = False
+      _lock_depth -= 1
+      if self._lock is not None:
+        self._lock.__exit__()
+      _thread_lock.release()
+
+  def timer_exists(self, label):
+    timer = self._timers.get(label)
+    if timer is not None:
+      return not timer._clear_called
+    return timer_exists(label)
+
+  def timer(self, label):
+    '''Returns the timer with the given label, creating it if needed.'''
+    timer = self._timers.get(label)
+    if timer is None or timer._clear_called:
+      timer = TimerFileProxy(label, self._read_only)
+      timer._load(from_file=label not in self._timers)
+      self._timers[label] = timer
+    return timer
+
+  def existing_timers(self):
+    if not self._scanned:
+      for label in _existing_labels():
+        timer = self.timer(label)
+        if self._read_only and not timer._loaded_from_file:
+          del self._timers[label]  # Cleared since it was listed.
+      self._scanned = True
+    return [self._timers[label] for label in sorted(self._timers)
+            if not self._timers[label]._clear_called]
+
+  def running_timer(self):
+    '''Returns the running foreground timer, ignoring scheduled timers.'''
+    running_timer = None
+    for timer in self.running_timers():
+      if timer.scheduled:
+        continue
+      # There should never be more than one running foreground timer.
+      assert running_timer is None or self._read_only
+      running_timer = running_timer or timer
+    return running_timer
+
+  def running_timers(self):
+    return [t for t in self.existing_timers() if t.is_running]
+
+  def _add(self, timer):
+    assert timer._label not in self._timers
+    timer._read_only = self._read_only
+    timer._load()
+    self._timers[timer._label] = timer
+
+  def _commit(self):
+    # Renames happen together, once every file has been written.
+    with util.FsyncGroup(fsync=False) as group:
+      for timer in self._timers.values():
+        if not timer._clear_called:
+          # Skipped by util if the timer is unchanged.
+          util.write_json_atomic(_timer_filepath(timer._label),
+                                 timer._timer_obj, group)
+    for timer in self._timers.values():
+      filepath = _timer_filepath(timer._label)
+      if timer._clear_called and os.path.isfile(filepath):
+        os.remove(filepath)  # Delete timer.
 
 
 class _check_preconditions(object):
-  def __init__(self, assert_running_is=None):
+  def __init__(self, assert_running_is=None, mutates=False):
     self._assert_running_is = assert_running_is
+    self._mutates = mutates
 
   def __call__(self, method):
     @functools.wraps(method)
     def wrapper(method_self, *args, **kwargs):
       assert method_self._enter_called, (
           'TimerFileProxy must be used within a `with` statement.')
+      assert not (self._mutates and method_self._read_only), (
+          'Timers read with read_only=True cannot be changed.')
       if self._assert_running_is is not None:
         assert method_self.is_running == self._assert_running_is
       return method(method_self, *args, **kwargs)
@@ -54,10 +170,12 @@ class _check_preconditions(object):
 
 
 class TimerFileProxy(object):
-  def __init__(self, label):
+  def __init__(self, label, read_only=False):
     self._label = label
+    self._read_only = read_only  # See Transaction.
     self._enter_called = False
     self._clear_called = False
+    self._loaded_from_file = False
 
   @property
   @_check_preconditions()
@@ -97,17 +215,33 @@ class TimerFileProxy(object):
   def is_complete(self):
     return self.remaining <= 0
 
-  @_check_preconditions(assert_running_is=False)
+  @property
+  @_check_preconditions()
+  def scheduled(self):
+    '''Scheduler settings ({'count', 'track'}) or None for foreground timers.
+    '''
+    return self._timer_obj.get('scheduled')
+
+  @_check_preconditions(assert_running_is=False, mutates=True)
+  def schedule(self, count, track):
+    '''Hands the timer to the scheduler process (see timer_scheduler.py).'''
+    self._timer_obj['scheduled'] = {'count': count, 'track': track}
+
+  @_check_preconditions(assert_running_is=False, mutates=True)
+  def unschedule(self):
+    self._timer_obj.pop('scheduled', None)
+
+  @_check_preconditions(assert_running_is=False, mutates=True)
   def start(self, seconds, minutes, hours):
     duration = seconds + minutes * 60 + hours * 3600
     self._timer_obj['endtime'] = time.time() + duration
 
-  @_check_preconditions(assert_running_is=False)
+  @_check_preconditions(assert_running_is=False, mutates=True)
   def resume(self):
     assert self.remaining >= 0
     self._timer_obj['endtime'] = int(round(time.time() + self.remaining))
 
-  @_check_preconditions()
+  @_check_preconditions(mutates=True)
   def pause(self):
     if self.is_running:
       self._timer_obj['remaining'] = int(round(self.endtime - time.time()))
@@ -115,42 +249,54 @@ class TimerFileProxy(object):
       self._timer_obj['interruptions'] += 1
     return self.remaining
 
-  @_check_preconditions()
+  @_check_preconditions(mutates=True)
   def clear(self):
     if self.is_running:
       self.pause()
     self._clear_called = True
 
-  @_check_preconditions(assert_running_is=True)
+  @_check_preconditions(assert_running_is=True, mutates=True)
   def inc(self, delta):
     self._timer_obj['endtime'] += delta
 
-  def __enter__(self):
-    # TODO(alive): Should likely hold the file lock throughout the entire `with`
-    #              statement.
+  def _load(self, from_file=True):
     # TODO(alive): Explicitly create timer files. This can cause subtle bugs.
     self._enter_called = True
-    if not os.path.isfile(self.filepath):
+    self._clear_called = False
+    self._loaded_from_file = False
+    filepath = _timer_filepath(self._label)
+    if from_file:
+      try:
+        # Read-only proxies never modify the object, so share the cached one.
+        self._timer_obj = util.read_json(filepath, copy=not self._read_only)
+        self._loaded_from_file = True
+      except FileNotFoundError:
+        pass  # A new timer, or one cleared since it was listed.
+    if not self._loaded_from_file:
       self._timer_obj = {
         'label': self._label,
         'endtime': 0,  # This field is 0 when the timer is not running.
         'remaining': sys.maxsize,
         'interruptions': 0
       }
-      with util.OpenAndLock(self.filepath, 'w') as f:
-        f.write(util.json_dumps(self._timer_obj))
-    else:
-      with util.OpenAndLock(self.filepath, 'r') as f:
-        self._timer_obj = json.load(f)
+
+  def __enter__(self):
+    # The lock is held for the entire `with` statement, unless read-only.
+    self._transaction = Transaction(self._read_only)
+    self._transaction.__enter__()
+    self._transaction._add(self)
     return self
 
   def __exit__(self, *args):
-    if self._clear_called:
-      os.remove(self.filepath)  # Delete timer.
-    else:
-      with util.OpenAndLock(self.filepath, 'w') as f:
-        f.write(util.json_dumps(self._timer_obj))
-    self._enter_called = False
+    self._transaction.__exit__(*args)
+    self._transaction = None
+
+
+def _existing_labels():
+  filepaths = (f for f in os.listdir(_DIRECTORY_PATH)
+               if os.path.isfile(os.path.join(_DIRECTORY_PATH, f)))
+  timer_filenames = (f for f in filepaths if f.endswith(_TIMER_FILE_SUFFIX))
+  return (f[:f.rfind(_TIMER_FILE_SUFFIX)] for f in timer_filenames)
 
 
 def _timer_filepath(label):
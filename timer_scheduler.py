@@ -0,0 +1,219 @@
+"""Runs any number of timers from a single process.
+
+Timers started with `walros timer start --scheduled` are not watched by the
+process that started them. Instead, one long-lived scheduler
+(`walros timer scheduler`) keeps every running scheduled timer in a heap
+ordered by end time and sleeps until the earliest deadline. `start --scheduled`
+and `clear` wake it by writing to a FIFO in timer_dir, so that new or changed
+timers are picked up immediately. The scheduler holds a lock on
+LOCK_FILENAME while it runs, which keeps a second one from starting.
+
+The timer files remain the source of truth: the heap is only a cache of end
+times, and each due timer is re-read from timer_db before it fires.
+"""
+import concurrent.futures
+import fcntl
+import heapq
+import os
+import select
+import time
+
+import config
+import timer_db
+import util
+
+_config = config.Config()
+
+LOCK_FILENAME = ".scheduler.lock"
+FIFO_FILENAME = ".scheduler.fifo"
+MAX_SLEEP = 60.0  # Seconds. Bounds how late unsignalled file edits are seen.
+COMPLETION_WORKERS = 4  # Completions make API calls; keep them off the loop.
+# Seconds before a failed completion is retried; doubles with each failure.
+RETRY_DELAY = 60.0
+RETRY_MAX_DELAY = 3600.0
+
+
+class Scheduler(object):
+  """A heap of (endtime, label) pairs for running scheduled timers.
+
+  `on_complete(label, count, track)` is called from a worker thread for each
+  timer that reaches its end time. The timer is left untouched until the
+  call returns; clearing it is up to `on_complete`. If it raises, the timer
+  fires again after RETRY_DELAY, doubling up to RETRY_MAX_DELAY.
+  """
+  def __init__(self, on_complete, clock=time.time,
+               max_workers=COMPLETION_WORKERS):
+    self._on_complete = on_complete
+    self._clock = clock
+    self._heap = []
+    self._endtimes = {}  # label -> endtime of the label's live heap entry.
+    self._firing = {}  # label -> future of its running completion.
+    self._failures = {}  # label -> (failed completions, time of next retry).
+    self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+
+  def __len__(self):
+    return len(self._endtimes)
+
+  def reload(self):
+    """Synchronizes the heap with the scheduled timers in timer_db.
+
+    A timer whose completion failed is still running, so it fires again once
+    its retry is due.
+    """
+    self._reap()
+    with timer_db.Transaction(read_only=True) as txn:
+      endtimes = dict((t.label, t.endtime) for t in txn.running_timers()
+                      if t.scheduled and t.label not in self._firing)
+    for label, endtime in endtimes.items():
+      self._push(label, self._deadline(label, endtime))
+    for label in set(self._endtimes) - set(endtimes):
+      del self._endtimes[label]  # Its heap entry is now stale.
+    for label in set(self._failures) - set(endtimes) - set(self._firing):
+      del self._failures[label]  # Completed, cleared or changed by hand.
+
+  def next_deadline(self):
+    """Returns the earliest end time, or None if no timer is scheduled."""
+    heap = self._heap
+    while heap and self._endtimes.get(heap[0][1]) != heap[0][0]:
+      heapq.heappop(heap)  # Stale: the timer was changed or removed.
+    return heap[0][0] if heap else None
+
+  def fire_due(self):
+    """Starts completions for all timers past their end time.
+
+    Returns the labels of the timers that fired.
+    """
+    now = self._clock()
+    due = []
+    while True:
+      deadline = self.next_deadline()
+      if deadline is None or deadline > now:
+        break
+      _, label = heapq.heappop(self._heap)
+      del self._endtimes[label]
+      due.append(label)
+    if not due:
+      return []
+
+    # Timers may have been paused, cleared or extended since the last reload.
+    fired = []
+    with timer_db.Transaction(read_only=True) as txn:
+      for label in due:
+        if not txn.timer_exists(label):
+          continue
+        timer = txn.timer(label)
+        if not timer.is_running or not timer.scheduled:
+          continue
+        deadline = self._deadline(label, timer.endtime)
+        if deadline > now:
+          self._push(label, deadline)
+          continue
+        fired.append((label, timer.scheduled))
+
+    for label, settings in fired:
+      self._firing[label] = self._executor.submit(
+          self._complete, label, settings["count"], settings["track"])
+    return [label for label, _ in fired]
+
+  def wait_idle(self):
+    """Blocks until all started completions have returned."""
+    concurrent.futures.wait(list(self._firing.values()))
+    self._reap()
+
+  def run(self):
+    """Fires timers until interrupted. Only one scheduler may run at a time.
+    """
+    # Released by the kernel if this process dies.
+    lock_file = open(_filepath(LOCK_FILENAME), "a")
+    try:
+      fcntl.lockf(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+      lock_file.close()
+      raise Exception("A timer scheduler is already running")
+
+    fifo_filepath = _filepath(FIFO_FILENAME)
+    if not os.path.exists(fifo_filepath):
+      os.mkfifo(fifo_filepath, 0o600)
+    wake_fd = os.open(fifo_filepath, os.O_RDONLY | os.O_NONBLOCK)
+    # Without a writer, select() would report end of file in a loop.
+    writer_fd = os.open(fifo_filepath, os.O_WRONLY)
+
+    try:
+      last_reload = None
+      while True:
+        now = self._clock()
+        if last_reload is None or now - last_reload >= MAX_SLEEP:
+          self.reload()
+          last_reload = now
+        self.fire_due()
+
+        deadline = self.next_deadline()
+        timeout = MAX_SLEEP - (self._clock() - last_reload)
+        if deadline is not None:
+          timeout = min(timeout, deadline - self._clock())
+        readable, _, _ = select.select([wake_fd], [], [], max(timeout, 0))
+        if readable:
+          while True:
+            try:
+              if not os.read(wake_fd, 512):
+                break
+            except BlockingIOError:
+              break
+          last_reload = None
+    finally:
+      os.close(wake_fd)
+      os.close(writer_fd)
+      self._executor.shutdown(wait=True)
+      lock_file.close()
+
+  def _push(self, label, endtime):
+    if self._endtimes.get(label) != endtime:
+      self._endtimes[label] = endtime
+      heapq.heappush(self._heap, (endtime, label))
+
+  def _deadline(self, label, endtime):
+    failures = self._failures.get(label)
+    return max(endtime, failures[1]) if failures else endtime
+
+  def _complete(self, label, count, track):
+    """Returns whether `on_complete` succeeded."""
+    try:
+      self._on_complete(label, count, track)
+    except Exception as ex:
+      util.tlog("Completing timer `%s` failed: %s" % (label, ex))
+      return False
+    return True
+
+  def _reap(self):
+    for label, future in list(self._firing.items()):
+      if not future.done():
+        continue
+      del self._firing[label]
+      if future.result():
+        self._failures.pop(label, None)
+        continue
+      failures = self._failures.get(label, (0, None))[0]
+      delay = min(RETRY_DELAY * 2 ** failures, RETRY_MAX_DELAY)
+      self._failures[label] = (failures + 1, self._clock() + delay)
+      util.tlog("Retrying timer `%s` in %d seconds" % (label, delay))
+
+
+def wake():
+  """Asks the scheduler to re-read timer_db. Returns False if none is running.
+  """
+  try:
+    # Fails with ENXIO unless a scheduler has the FIFO open for reading.
+    fd = os.open(_filepath(FIFO_FILENAME), os.O_WRONLY | os.O_NONBLOCK)
+  except OSError:
+    return False
+  try:
+    os.write(fd, b"\0")
+  except BlockingIOError:
+    pass  # The FIFO is full of wakeups the scheduler has yet to read.
+  finally:
+    os.close(fd)
+  return True
+
+
+def _filepath(filename):
+  return os.path.join(_config.timer_dir, filename)
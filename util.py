@@ -1,9 +1,28 @@
+import collections
 import datetime
 import fcntl
 import json
+import os
+import os.path
+import tempfile
 
 import click
 
+import profiler
+
+# Per-process cache of files read or written through read_json and
+# write_json_atomic: filepath -> [(st_ino, st_mtime_ns, st_size), JSON text,
+# object shared by read_json(copy=False) callers or None until requested].
+_json_cache = {}
+
+# Counts read_hits, read_misses, writes and skipped_writes.
+storage_stats = collections.Counter()
+
+# Mode of files created with open(); mkstemp's are 0600.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+_DEFAULT_FILE_MODE = 0o666 & ~_UMASK
+
 class OpenAndLock(object):
   def __init__(self, filepath, open_mode):
     self.filepath_ = filepath
@@ -14,8 +33,9 @@ class OpenAndLock(object):
       self.lock_mode_ = fcntl.LOCK_SH
 
   def __enter__(self):
-    self.file_ = open(self.filepath_, self.open_mode_)
-    fcntl.lockf(self.file_.fileno(), self.lock_mode_)
+    with profiler.span("OpenAndLock", path=self.filepath_):
+      self.file_ = open(self.filepath_, self.open_mode_)
+      fcntl.lockf(self.file_.fileno(), self.lock_mode_)
     return self.file_
 
   def __exit__(self, *args):
@@ -24,6 +44,127 @@ class OpenAndLock(object):
     self.file_.close()
 
 
+class FsyncGroup(object):
+  """Makes a group of atomic writes durable together.
+
+  Files passed to `write_json_atomic` within the `with` block are written to
+  temporary files, fsynced, and only then moved into place, followed by one
+  fsync per directory. If the block raises, none of them are moved in.
+
+  With `fsync=False`, only the all-or-nothing renames are kept.
+  """
+  def __init__(self, fsync=True):
+    self.fsync_ = fsync
+    self.pending_ = []  # (temporary filepath, filepath)
+
+  def add(self, tmp_filepath, filepath):
+    self.pending_.append((tmp_filepath, filepath))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, *args):
+    pending, self.pending_ = self.pending_, []
+    if exc_type is not None:
+      for tmp_filepath, _ in pending:
+        os.remove(tmp_filepath)
+      return
+
+    if self.fsync_:
+      for tmp_filepath, _ in pending:
+        _fsync_path(tmp_filepath)
+    for tmp_filepath, filepath in pending:
+      os.replace(tmp_filepath, filepath)
+    if self.fsync_:
+      for dirpath in set(os.path.dirname(f) for _, f in pending):
+        _fsync_path(dirpath)
+
+
+def write_json_atomic(filepath, obj, fsync_group=None):
+  """Replaces the contents of `filepath` with `obj`, serialized as JSON.
+
+  The data is written to a temporary file in the same directory and renamed
+  over `filepath`, so readers see either the old or the new contents, never
+  a truncated file. Without `fsync_group`, the write is not fsynced.
+
+  The write is skipped if `filepath` still holds what this process last read
+  or wrote there and `obj` is equal to it.
+  """
+  cached = _json_cache.get(filepath)
+  if (cached is not None and cached[0] == _stat_key(filepath) and
+      _shared_object(cached) == obj):
+    storage_stats['skipped_writes'] += 1
+    return
+
+  text = json_dumps(obj)
+
+  dirpath, filename = os.path.split(filepath)
+  fd, tmp_filepath = tempfile.mkstemp(dir=dirpath, prefix="." + filename + ".")
+  try:
+    try:
+      mode = os.stat(filepath).st_mode & 0o7777  # Keeps the file's mode.
+    except FileNotFoundError:
+      mode = _DEFAULT_FILE_MODE
+    os.fchmod(fd, mode)
+    with os.fdopen(fd, 'w') as f:
+      f.write(text)
+      f.flush()
+      # The inode, mtime and size survive the rename below.
+      _json_cache[filepath] = [_stat_key(f.fileno()), text, None]
+  except:
+    _json_cache.pop(filepath, None)
+    os.remove(tmp_filepath)
+    raise
+
+  storage_stats['writes'] += 1
+  if fsync_group is not None:
+    fsync_group.add(tmp_filepath, filepath)
+  else:
+    os.replace(tmp_filepath, filepath)
+
+
+def read_json(filepath, copy=True):
+  """Reads a file written with `write_json_atomic`. Takes no lock.
+
+  Files that have not changed since this process last read or wrote them,
+  according to their inode, mtime and size, are not read again. With
+  `copy=False`, unchanged files return the same object every time, which
+  callers must not modify.
+  """
+  cached = _json_cache.get(filepath)
+  if cached is not None and cached[0] == _stat_key(filepath):
+    storage_stats['read_hits'] += 1
+  else:
+    storage_stats['read_misses'] += 1
+    with open(filepath) as f:
+      cached = [_stat_key(f.fileno()), f.read(), None]
+    _json_cache[filepath] = cached
+
+  return json.loads(cached[1]) if copy else _shared_object(cached)
+
+
+def _shared_object(cached):
+  if cached[2] is None:
+    cached[2] = json.loads(cached[1])
+  return cached[2]
+
+
+def _stat_key(path_or_fd):
+  try:
+    st = os.stat(path_or_fd)
+  except FileNotFoundError:
+    return None
+  return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _fsync_path(path):
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+
 # Echo log message with timestamp.
 def tlog(message, prefix=''):
   click.echo("%s%s: %s." %
@@ -1,23 +1,78 @@
 #!/usr/bin/env python3
+import time
+_IMPORTS_START = time.time()  # Reported by --profile.
+
+import os
 import traceback
 
 import click
 
-import habits as habits_module
-import diary as diary_module
-import timer as timer_module
+import label_index
+
+# Shell completion runs this script on every keystroke; it only needs the
+# labels in label_index, not the modules behind the commands.
+if not label_index.is_completing():
+  import api_stats
+  import data_util
+  import habits as habits_module
+  import diary as diary_module
+  import profiler
+  import timer as timer_module
+  import util
+  import walros_base
+
+_IMPORTS_END = time.time()
 
 
 @click.group()
-def walros():
-  pass
+@click.option("--profile", is_flag=True,
+              help="Record timing spans and write them as a Chrome trace.")
+@click.option("--profile-output", default="~/.walros/trace.json",
+              show_default=True)
+@click.pass_context
+def walros(ctx, profile, profile_output):
+  if profile:
+    profiler.enable()
+    profiler.add_span("imports", _IMPORTS_START, _IMPORTS_END)
+    command_start = time.time()
+
+    def finish():
+      profiler.add_span(ctx.invoked_subcommand, command_start, time.time())
+      write_profile(os.path.expanduser(profile_output))
+    ctx.call_on_close(finish)
+
+
+def write_profile(filepath):
+  profiler.write_trace(filepath)
+  click.echo("Profile written to %s" % filepath, err=True)
+  for name, count, total in profiler.summary():
+    click.echo("  %-24s %5d  %9.1f ms" % (name, count, total * 1000),
+               err=True)
+  click.echo("  storage: %(read_hits)d cached reads, %(read_misses)d file "
+             "reads, %(writes)d writes, %(skipped_writes)d skipped writes" %
+             util.storage_stats, err=True)
 
 
 @walros.command()
+@click.option("--verify", is_flag=True,
+              help="Check the spreadsheet even if this machine already "
+                   "initialized it today.")
+@click.option("--plan", is_flag=True,
+              help="Print the requests init would send, without sending "
+                   "them.")
 @click.pass_context
-def init(ctx):
-  timer_module.init_command()
-  habits_module.init_command()
+def init(ctx, verify, plan):
+  walros_base.init_trackers([timer_module.init_tracker_data(),
+                             habits_module.init_tracker_data()], verify, plan)
+
+
+@walros.command()
+@click.option("--margin", default=900,
+              help="Refresh the access token if it expires within this many "
+                   "seconds.")
+def auth(margin):
+  expiry = data_util.RefreshCredentials(margin)
+  click.echo("Access token valid until %s UTC" % expiry)
 
 
 # -- Timer --
@@ -27,8 +82,11 @@ def timer():
   timer_module.setup()
 
 @timer.command()
-def init():
-  timer_module.init_command()
+@click.option("--verify", is_flag=True,
+              help="Check the spreadsheet even if this machine already "
+                   "initialized it today.")
+def init(verify):
+  timer_module.init_command(verify)
 
 
 @timer.command()
@@ -41,16 +99,28 @@ def init():
 @click.option("-c", "--count", default=1)
 @click.option("--track/--no-track", default=True)
 @click.option("--force", is_flag=True)
+@click.option("--scheduled", is_flag=True,
+              help="Hand the timer to `walros timer scheduler` and return "
+                   "immediately.")
 def start(label, seconds, minutes, hours, whitenoise, diary, count, track,
-          force):
+          force, scheduled):
   if diary:
     diary_module.new_command(label)
   timer_module.start_command(
-      label, seconds, minutes, hours, whitenoise, count, track, force)
+      label, seconds, minutes, hours, whitenoise, count, track, force,
+      scheduled)
+
+
+@timer.command()
+def scheduler():
+  """Run all timers started with --scheduled."""
+  timer_module.scheduler_command()
 
 
 @timer.command()
-@click.option("-d", "--data", is_flag=True)
+@click.option("-d", "--data", is_flag=True,
+              help="Print the foreground timer's state as JSON, as published "
+                   "by its timer loop.")
 def status(data):
   timer_module.status_command(data)
 
@@ -106,13 +176,71 @@ def habits():
   pass
 
 @habits.command()
-def init():
-  habits_module.init_command()
+@click.option("--verify", is_flag=True,
+              help="Check the spreadsheet even if this machine already "
+                   "initialized it today.")
+def init(verify):
+  habits_module.init_command(verify)
+
+
+@habits.command()
+@click.argument("marks", nargs=-1, required=True, metavar="LABEL[=VALUE]...")
+def mark(marks):
+  """Set today's value for each habit (1 if no value is given)."""
+  habits_module.mark_command(marks)
+
+
+# -- Mirror --
+
+@walros.group()
+def mirror():
+  pass
+
+@mirror.command()
+@click.option("--full", is_flag=True,
+              help="Fetch every day row instead of only the new ones.")
+def sync(full):
+  import mirror as mirror_module  # NumPy is slow to import.
+  mirror_module.sync_command([timer_module.init_tracker_data(),
+                              habits_module.init_tracker_data()], full)
+
+@mirror.command()
+@click.argument("label")
+@click.option("--days", default=14, show_default=True)
+def show(label, days):
+  import mirror as mirror_module
+  mirror_module.show_command([timer_module.init_tracker_data(),
+                              habits_module.init_tracker_data()], label, days)
+
+
+@walros.command()
+@click.option("--plan", is_flag=True,
+              help="Print the requests without sending them.")
+def materialize(plan):
+  """Replace closed scores and reductions with their values."""
+  import materialize as materialize_module  # NumPy is slow to import.
+  materialize_module.history_command([timer_module.init_tracker_data(),
+                                      habits_module.init_tracker_data()], plan)
+
+
+# -- Stats --
+
+@walros.group()
+def stats():
+  pass
+
+@stats.command()
+@click.option("--days", default=30, show_default=True)
+def api(days):
+  api_stats.report_command(days)
 
 
 if __name__ == "__main__":
   try:
-    walros()
+    if label_index.is_completing():
+      label_index.complete(walros)
+    else:
+      walros()
 
   except Exception as ex:
     click.echo(traceback.format_exc())
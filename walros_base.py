@@ -1,14 +1,27 @@
+import asyncio
 import copy
 import datetime
+import json
+import os
 
 import click
 
+import config
 import data_util
+import metrics
+import util
 from data_util import UpdateCellsMode
 
 SPREADSHEET_ID = "1JvO-sjs2kCFFD2FcX1a7XQ8uYyj-9o-anS9RElrtXYI"
 DATE_FORMAT = "%Y-%m-%d %A"
 
+# One JSON file per worksheet, recording what init last did locally.
+INIT_STATE_DIRPATH = "~/.walros/init"
+
+# Init requests are sent in batchUpdates of at most this much JSON, well
+# under the Sheets request size limit.
+MAX_CHUNK_BYTES = 1 << 20
+
 
 class TrackerData(object):
   def __init__(self):
@@ -29,6 +42,20 @@ class TrackerData(object):
     # It's set to `reduce_formula` above, by default.
     self.reduce_formula_final = self.reduce_formula
 
+    # Builds requests that update sheet wide statistics after new days are
+    # inserted. Takes (worksheet, tracker_data).
+    self.build_statistics_requests = lambda w, t: []
+
+    # Numeric counterparts of the formulas above, for materialized mode (see
+    # materialize.py). Reduce kinds are keys of materialize.REDUCTIONS.
+    # `compute_scores` takes (header rows by name, day values, named ranges)
+    # for the day columns after the first, one row per day, and returns the
+    # day scores; None leaves scores as formulas.
+    self.reduce_kind = "sum"
+    self.reduce_kind_final = self.reduce_kind
+    self.compute_scores = None
+    self.named_ranges = []  # Mirrored along with the day rows.
+
 
   @property
   def row_margin(self):
@@ -90,7 +117,223 @@ class TrackerData(object):
       return -3
 
 
+def init_trackers(tracker_datas, verify=False, plan=False):
+  """Inserts rows up to today on every tracker, with concurrent API calls.
+
+  Trackers that this machine already initialized today are skipped without
+  any network I/O, unless `verify` is set. With `plan`, the requests are
+  summarized instead of sent.
+  """
+  dirpath = os.path.expanduser(INIT_STATE_DIRPATH)
+  if not os.path.isdir(dirpath):
+    os.makedirs(dirpath)
+
+  # Concurrent inits (several shells, cron) would insert the same rows twice.
+  with util.OpenAndLock(os.path.join(dirpath, ".lock"), 'a'):
+    today = datetime.date.today().isoformat()
+    if not verify:
+      pending = []
+      for tracker_data in tracker_datas:
+        if load_init_state(tracker_data).get("initialized") == today:
+          util.tlog("%s sheet is already initialized for today" %
+                    tracker_data.worksheet_name)
+        else:
+          pending.append(tracker_data)
+      tracker_datas = pending
+      if not tracker_datas:
+        return
+
+    # Materialized mode computes closed periods from an up to date mirror.
+    mirrors = {}
+    if config.Config().materialized:
+      import mirror  # NumPy is slow to import.
+      sync_spreadsheet = data_util.Spreadsheet(SPREADSHEET_ID)
+      for tracker_data in tracker_datas:
+        mirrors[tracker_data.worksheet_id], _ = mirror.sync(tracker_data,
+                                                            sync_spreadsheet)
+
+    spreadsheet = data_util.AsyncSpreadsheet(SPREADSHEET_ID)
+
+    async def init_all():
+      await asyncio.gather(*[
+          init_tracker(t, spreadsheet, plan, mirrors.get(t.worksheet_id),
+                       verify)
+          for t in tracker_datas])
+    asyncio.run(init_all())
+
+
+async def init_tracker(tracker_data, spreadsheet, plan=False, mirror=None,
+                       verify=False):
+  # Taken before the read: the sheet is initialized for at least this date.
+  today = datetime.date.today().isoformat()
+
+  # An interrupted backfill must finish before the sheet can be read again.
+  state = load_init_state(tracker_data)
+  backfill = state.get("backfill")
+  if backfill:
+    if plan:
+      print_plan(tracker_data, backfill["chunks"], resuming=True)
+      return
+    util.tlog("Resuming %s sheet backfill (%d chunks left)" % (
+        tracker_data.worksheet_name, len(backfill["chunks"])))
+    await commit_backfill(tracker_data, spreadsheet, backfill, resuming=True)
+    save_init_state(tracker_data, open_merges=backfill.get("open_merges"))
+    if backfill["date"] == today:
+      save_init_state(tracker_data, initialized=today)
+      metrics.record_init(tracker_data.worksheet_name)
+      return
+    state = load_init_state(tracker_data)
+
+  # The open period merges recorded by the last init spare downloading them,
+  # as long as the sheet's last date is still the one they were recorded at.
+  worksheet = spreadsheet.GetWorksheet(tracker_data.worksheet_id)
+  merge_ranges = None if verify else state.get("open_merges")
+  response = None
+  if merge_ranges:
+    response = await spreadsheet.GetRanges(
+        ["%s!A%d" % (tracker_data.worksheet_name,
+                     tracker_data.last_day_row_index)],
+        "sheets/data/rowData/values/formattedValue")
+    if last_date_from_response(response).isoformat() != merge_ranges["date"]:
+      merge_ranges = None
+  if not merge_ranges:
+    ranges, fields = build_init_ranges(tracker_data)
+    response = await spreadsheet.GetRanges(ranges, fields)
+
+  open_merges = {}
+  init_requests = build_init_requests_from_response(
+      tracker_data, worksheet, response, mirror, merge_ranges, open_merges)
+  if len(init_requests) == 0:
+    util.tlog("%s sheet is already initialized for today" %
+              tracker_data.worksheet_name)
+    if not plan:
+      save_init_state(tracker_data, initialized=today,
+                      open_merges=open_merges)
+      metrics.record_init(tracker_data.worksheet_name)
+    return
+
+  # Update sheet wide statistics.
+  init_requests += tracker_data.build_statistics_requests(worksheet,
+                                                          tracker_data)
+
+  chunks = plan_chunks(init_requests)
+  if plan:
+    print_plan(tracker_data, chunks)
+    return
+
+  # Send requests.
+  await commit_backfill(tracker_data, spreadsheet,
+                        {"date": today, "chunks": chunks,
+                         "open_merges": open_merges,
+                         "last_date":
+                             last_date_from_response(response).isoformat()})
+  save_init_state(tracker_data, initialized=today, open_merges=open_merges)
+  metrics.record_init(tracker_data.worksheet_name)
+
+
+def plan_chunks(requests, max_bytes=MAX_CHUNK_BYTES):
+  """Splits requests, in order, into batches of at most `max_bytes` of JSON.
+
+  A single request larger than `max_bytes` gets a batch of its own.
+  """
+  chunks = []
+  chunk, chunk_bytes = [], 0
+  for request in requests:
+    request_bytes = len(json.dumps(request))
+    if chunk and chunk_bytes + request_bytes > max_bytes:
+      chunks.append(chunk)
+      chunk, chunk_bytes = [], 0
+    chunk.append(request)
+    chunk_bytes += request_bytes
+  if chunk:
+    chunks.append(chunk)
+  return chunks
+
+
+async def commit_backfill(tracker_data, spreadsheet, backfill,
+                          resuming=False):
+  """Sends the backfill's chunks in order, checkpointing after each one.
+
+  Each chunk is one batchUpdate, so it is applied entirely or not at all.
+  A backfill of a single chunk needs no checkpoint.
+
+  A chunk may have been applied without being checkpointed. Sending it again
+  only rewrites the same cells and merges, except for the chunk that inserts
+  the new rows: when `resuming`, it is skipped if the sheet's last tracked
+  date is no longer the backfill's "last_date".
+  """
+  chunks = backfill["chunks"]
+  checkpointed = "backfill" in load_init_state(tracker_data)
+  if (resuming and chunks and backfill.get("last_date") and
+      any("insertDimension" in request for request in chunks[0])):
+    response = await spreadsheet.GetRanges(
+        ["%s!A%d" % (tracker_data.worksheet_name,
+                     tracker_data.last_day_row_index)],
+        "sheets/data/rowData/values/formattedValue")
+    if formatted_value_from_response(response) != datetime.date.fromisoformat(
+        backfill["last_date"]).strftime(DATE_FORMAT):
+      util.tlog("%s sheet already has the new rows; skipping their chunk" %
+                tracker_data.worksheet_name)
+      chunks.pop(0)
+      save_init_state(tracker_data, backfill=backfill if chunks else None)
+  if len(chunks) > 1 and not checkpointed:
+    save_init_state(tracker_data, backfill=backfill)
+    checkpointed = True
+  while chunks:
+    metrics.set_pending_writes(tracker_data.worksheet_name,
+                               sum(len(chunk) for chunk in chunks))
+    await spreadsheet.BatchUpdate(chunks[0])
+    chunks.pop(0)
+    if checkpointed:
+      save_init_state(tracker_data, backfill=backfill if chunks else None)
+  metrics.set_pending_writes(tracker_data.worksheet_name, 0)
+
+
+def print_plan(tracker_data, chunks, resuming=False):
+  num_requests = sum(len(chunk) for chunk in chunks)
+  num_bytes = sum(len(json.dumps(request))
+                  for chunk in chunks for request in chunk)
+  click.echo("%s: %d requests, %d bytes in %d chunks%s" % (
+      tracker_data.worksheet_name, num_requests, num_bytes, len(chunks),
+      " (resuming an interrupted backfill)" if resuming else ""))
+
+
+def init_state_filepath(tracker_data):
+  return os.path.join(os.path.expanduser(INIT_STATE_DIRPATH),
+                      "%s.json" % tracker_data.worksheet_name)
+
+
+def load_init_state(tracker_data):
+  """Returns the worksheet's local init state, or {} if there is none.
+
+  State recorded for a different spreadsheet or worksheet is ignored.
+  """
+  filepath = init_state_filepath(tracker_data)
+  if not os.path.isfile(filepath):
+    return {}
+  state = util.read_json(filepath)
+  if (state.get("spreadsheet_id") != SPREADSHEET_ID or
+      state.get("worksheet_id") != tracker_data.worksheet_id):
+    return {}
+  return state
+
+
+def save_init_state(tracker_data, **fields):
+  state = load_init_state(tracker_data)
+  state.update(fields)
+  state = dict((k, v) for k, v in state.items() if v is not None)
+  state["spreadsheet_id"] = SPREADSHEET_ID
+  state["worksheet_id"] = tracker_data.worksheet_id
+  util.write_json_atomic(init_state_filepath(tracker_data), state)
+
+
 def build_init_requests(tracker_data, spreadsheet, worksheet):
+  ranges, fields = build_init_ranges(tracker_data)
+  response = spreadsheet.GetRanges(ranges, fields)
+  return build_init_requests_from_response(tracker_data, worksheet, response)
+
+
+def build_init_ranges(tracker_data):
   # Relevant ranges to fetch from time sheet.
   ranges = []
   ranges.append("A%d" % tracker_data.last_day_row_index)  # Last date tracked.
@@ -100,41 +343,70 @@ def build_init_requests(tracker_data, spreadsheet, worksheet):
 
   # Prepend sheet name to all ranges.
   ranges = ["%s!%s" % (tracker_data.worksheet_name, x) for x in ranges]
-  response = spreadsheet.GetRanges(ranges, fields="sheets(data,merges)")
+  return ranges, "sheets(data,merges)"
+
+
+def build_init_requests_from_response(tracker_data, worksheet, response,
+                                      mirror=None, merge_ranges=None,
+                                      open_merges=None):
+  """Builds init requests from the response to the init ranges.
 
+  `merge_ranges`, if given, holds the open week, month and quarter merges
+  recorded by the previous init, and the response need only contain the
+  last date. If `open_merges` is given, it receives the merges that are
+  open once the requests are applied.
+  """
   # Extract date information.
-  data = response['sheets'][0]["data"]
-  last_date_tracked_data = data[0]
-  last_date_tracked_string = (
-      last_date_tracked_data['rowData'][0]['values'][0]['formattedValue'])
-  last_date_tracked = datetime.datetime.strptime(
-      last_date_tracked_string, DATE_FORMAT).date()
+  last_date_tracked = last_date_from_response(response)
   today = datetime.date.today()
-  if today == last_date_tracked:
-    return []
 
   # Exctract cell merge information.
-  week_merge_ranges = (
-      extract_merge_ranges(worksheet, response,
-                           tracker_data.week_merge_column_indices,
-                           tracker_data.last_day_row_index))
-  month_merge_ranges = (
-      extract_merge_ranges(worksheet, response,
-                           tracker_data.month_merge_column_indices,
-                           tracker_data.last_day_row_index))
-  quarter_merge_ranges = (
-      extract_merge_ranges(worksheet, response,
-                           tracker_data.quarter_merge_column_indices,
-                           tracker_data.last_day_row_index))
+  if merge_ranges is None:
+    merge_ranges = {
+      "week": extract_merge_ranges(worksheet, response,
+                                   tracker_data.week_merge_column_indices,
+                                   tracker_data.last_day_row_index),
+      "month": extract_merge_ranges(worksheet, response,
+                                    tracker_data.month_merge_column_indices,
+                                    tracker_data.last_day_row_index),
+      "quarter": extract_merge_ranges(
+          worksheet, response, tracker_data.quarter_merge_column_indices,
+          tracker_data.last_day_row_index),
+    }
+  merge_ranges = copy.deepcopy(merge_ranges)
+
+  if today == last_date_tracked:
+    if open_merges is not None:
+      merge_ranges["date"] = today.isoformat()
+      open_merges.update(merge_ranges)
+    return []
 
   # Insert new days.
   init_requests = build_new_day_requests(
       tracker_data, worksheet, today, last_date_tracked,
-      week_merge_ranges, month_merge_ranges, quarter_merge_ranges)
+      merge_ranges["week"], merge_ranges["month"], merge_ranges["quarter"],
+      mirror, open_merges)
 
   return init_requests
 
 
+def last_date_from_response(response):
+  last_date_tracked_data = response['sheets'][0]["data"][0]
+  last_date_tracked_string = (
+      last_date_tracked_data['rowData'][0]['values'][0]['formattedValue'])
+  return datetime.datetime.strptime(last_date_tracked_string,
+                                    DATE_FORMAT).date()
+
+
+def formatted_value_from_response(response):
+  """The first cell's formatted value, or None if the cell is empty."""
+  data = response['sheets'][0]["data"][0]
+  try:
+    return data['rowData'][0]['values'][0]['formattedValue']
+  except (KeyError, IndexError):
+    return None
+
+
 def extract_merge_ranges(worksheet, response_data, column_indices,
                          last_day_row_index):
   merges = response_data['sheets'][0].get("merges", [])
@@ -156,7 +428,14 @@ def build_new_merge_ranges(worksheet, row, column_indices):
 
 def build_new_day_requests(tracker_data, worksheet, today, last_date_tracked,
                            week_merge_ranges, month_merge_ranges,
-                           quarter_merge_ranges):
+                           quarter_merge_ranges, mirror=None,
+                           open_merges=None):
+  """Builds the requests that insert days up to `today`.
+
+  Given the worksheet's mirror (materialized mode), closed days' scores and
+  closed periods' reductions are written as numbers instead of formulas.
+  `open_merges` receives the merges still open at `today`.
+  """
   requests = []
   delta_days = (today - last_date_tracked).days
 
@@ -181,7 +460,16 @@ def build_new_day_requests(tracker_data, worksheet, today, last_date_tracked,
   # Deal with merges.
   requests += build_new_day_merge_requests(
       tracker_data, worksheet, today, last_date_tracked,
-      week_merge_ranges, month_merge_ranges, quarter_merge_ranges)
+      week_merge_ranges, month_merge_ranges, quarter_merge_ranges, mirror,
+      open_merges)
+
+  # The previous day's live score formula is now closed.
+  if mirror is not None:
+    import materialize
+    requests += materialize.build_score_requests(
+        tracker_data, worksheet, mirror,
+        [tracker_data.last_day_row_index + delta_days],
+        tracker_data.last_day_row_index, today)
 
   # For today's row, write per-column zero counts on anchor columns.
   if tracker_data.init_writes_zeros:
@@ -193,7 +481,8 @@ def build_new_day_requests(tracker_data, worksheet, today, last_date_tracked,
 
 def build_new_day_merge_requests(tracker_data, worksheet, today,
                                  last_date_tracked, week_merge_ranges,
-                                 month_merge_ranges, quarter_merge_ranges):
+                                 month_merge_ranges, quarter_merge_ranges,
+                                 mirror=None, open_merges=None):
   requests = []
   tmp_date = copy.deepcopy(last_date_tracked)
 
@@ -204,9 +493,16 @@ def build_new_day_merge_requests(tracker_data, worksheet, today,
     for merge_range in merge_ranges:
       merge_range["startRowIndex"] -= 1
 
-  def close_merge_range_requests(merge_ranges, column_indices):
+  def close_merge_range_requests(merge_ranges, column_indices, closed=True):
     range_obj = data_util.MergeRange(merge_ranges[0])
 
+    if mirror is not None and closed:
+      import materialize
+      requests.extend(materialize.build_reduce_requests(
+          tracker_data, worksheet, mirror, merge_ranges,
+          tracker_data.last_day_row_index, today))
+      column_indices = []  # Reduced above.
+
     # Write category reduce formulas
     for i, col in enumerate(column_indices):
       reduce_column_offset = tracker_data.reduce_column_offset(col)
@@ -269,12 +565,19 @@ def build_new_day_merge_requests(tracker_data, worksheet, today,
 
     tmp_date = tmp_next_date
 
+  if open_merges is not None:
+    open_merges.update(copy.deepcopy({"date": today.isoformat(),
+                                      "week": week_merge_ranges,
+                                      "month": month_merge_ranges,
+                                      "quarter": quarter_merge_ranges}))
+
+  # Periods containing today stay open and keep live formulas.
   close_merge_range_requests(week_merge_ranges,
-                             tracker_data.week_merge_column_indices)
+                             tracker_data.week_merge_column_indices, False)
   close_merge_range_requests(month_merge_ranges,
-                             tracker_data.month_merge_column_indices)
+                             tracker_data.month_merge_column_indices, False)
   close_merge_range_requests(quarter_merge_ranges,
-                             tracker_data.quarter_merge_column_indices)
+                             tracker_data.quarter_merge_column_indices, False)
   return requests
 
 